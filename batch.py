@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# Headless palette extraction for lots of images at once
+# Work is spread over a pool of processes, and results come out as JSON lines as soon as each image is done:
+# {"path": ..., "scheme": ..., "engine": ..., "sample_budget": ..., "exact_hsv": ..., "colors": [[r, g, b], ...],
+#  "timings": {"open": s, "histogram": s, "palette": s}}
+# An image that can't be processed gives a single {"path": ..., "error": ...} line instead
+#
+# Usage: python batch.py [--workers N] [--output results.jsonl] [--scheme TRIAD ...] file_or_directory ...
+# Running again with the same --output skips every image that already has results in it from the same engine,
+# sample budget and HSV conversion, and tries images that failed before again
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import Image
+import imaging
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".bmp")
+
+
+# Expands directories in to the images under them, in a stable order
+def find_images(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+# Computes the palettes of a single image, returns the JSON line dicts for it
+def extract_palette(path, schemes=imaging.Palette.SCHEMES, sample_budget=imaging.ColorFinder.SAMPLE_BUDGET, engine="grid", exact_hsv=True):
+    try:
+        timings = {}
+        start = time.time()
+        im = Image.open(path)
+        timings["open"] = time.time() - start
+        start = time.time()
+        cf = imaging.ColorFinder(im, sample_budget=sample_budget, engine=engine, exact_hsv=exact_hsv)
+        timings["histogram"] = time.time() - start
+        start = time.time()
+        palettes = cf.strategy_multi_complements(schemes)
+        timings["palette"] = time.time() - start
+    except Exception, e:
+        return [{"path": path, "error": "%s: %s" % (e.__class__.__name__, e)}]
+    results = []
+    for scheme in schemes:
+        colors = [list(color) for color in palettes[scheme]]
+        results.append({"path": path, "scheme": scheme, "engine": engine, "sample_budget": sample_budget,
+                        "exact_hsv": exact_hsv, "colors": colors, "timings": timings})
+    return results
+
+# multiprocessing can only hand a single argument to the workers
+def extract_palette_job(job):
+    return extract_palette(*job)
+
+# Yields the results of each image, in the order the workers finish them
+# workers=1 does all the work in this process
+def extract_palettes(paths, schemes=imaging.Palette.SCHEMES, workers=None, sample_budget=imaging.ColorFinder.SAMPLE_BUDGET, engine="grid", exact_hsv=True):
+    jobs = ((path, schemes, sample_budget, engine, exact_hsv) for path in paths)
+    if workers == 1:
+        for job in jobs:
+            yield extract_palette_job(job)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        for results in pool.imap_unordered(extract_palette_job, jobs):
+            yield results
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# Paths that already have results in an output file from an earlier run with the same settings
+# A line cut off by a crash doesn't parse and an error line isn't a result, so those images get done again
+def completed_paths(output_path, schemes, engine="grid", sample_budget=imaging.ColorFinder.SAMPLE_BUDGET, exact_hsv=True):
+    done = {}
+    if not os.path.exists(output_path):
+        return set()
+    settings = (engine, sample_budget, exact_hsv)
+    with open(output_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            if "error" in result:
+                continue
+            if (result.get("engine"), result.get("sample_budget"), result.get("exact_hsv")) != settings:
+                continue
+            done.setdefault(result["path"], set()).add(result["scheme"])
+    return set(path for path, found in done.items() if found.issuperset(schemes))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Extract palettes from images and write them as JSON lines.")
+    parser.add_argument("paths", nargs="+", help="image files or directories to search for images")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes (default: one per CPU)")
+    parser.add_argument("--output", help="file to append results to, images already in it are skipped (default: stdout)")
+    parser.add_argument("--scheme", action="append", dest="schemes", choices=imaging.Palette.SCHEMES,
+                        help="scheme to compute, can be given more than once (default: all of them)")
+    parser.add_argument("--sample-budget", type=int, default=imaging.ColorFinder.SAMPLE_BUDGET,
+                        help="roughly how many pixels to sample from each image")
+    parser.add_argument("--engine", choices=imaging.ColorFinder.ENGINES, default="grid",
+                        help="how to group similar colors together (default: grid)")
+    parser.add_argument("--fast-hsv", action="store_true",
+                        help="convert colors to HSV through a lookup table at 5 bits per channel, palettes can differ slightly")
+    args = parser.parse_args(argv)
+    schemes = args.schemes or imaging.Palette.SCHEMES
+
+    paths = find_images(args.paths)
+    if args.output:
+        done = completed_paths(args.output, schemes, args.engine, args.sample_budget, not args.fast_hsv)
+        paths = (path for path in paths if path not in done)
+        # make sure a line cut off by a crash doesn't run in to the next one
+        if os.path.exists(args.output) and os.path.getsize(args.output) > 0:
+            with open(args.output, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != "\n":
+                    with open(args.output, "a") as partial:
+                        partial.write("\n")
+        output = open(args.output, "a")
+    else:
+        output = sys.stdout
+
+    failures = 0
+    try:
+        for results in extract_palettes(paths, schemes, args.workers, args.sample_budget, args.engine, not args.fast_hsv):
+            for result in results:
+                if "error" in result:
+                    failures += 1
+                output.write(json.dumps(result) + "\n")
+            output.flush()
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
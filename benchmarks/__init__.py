@@ -0,0 +1,3 @@
+# Benchmarks for the imaging pipeline
+# Run them from the top of the repository, for example:
+# python -m benchmarks.priority_map
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Peak memory of ImageOperator.process, on top of the decoding and rendering it can't do without
+# Each run is in a fresh child process that is handed the upload, and reports how much its peak memory grew.
+# "process" runs the real ImageOperator.process, with blobs kept in a MemoryStorage and a stand-in for the
+# datastore model. "render" only calls the decode, render_derivatives and render_palette it is made of, and what
+# process needs on top of that, for its byte handling and blob writes, is given in units of the upload size.
+# The upload itself is already in memory, so passing it around without copies means close to zero extra
+#
+# python -m benchmarks.memory [--size 20mp] [--max-copies 0.5]
+#
+# The exit status is non-zero if process needs more than --max-copies uploads on top of rendering
+import argparse
+import imp
+import multiprocessing
+import sys
+
+from benchmarks import suite
+
+
+# Stands in for model.Picture, which needs the App Engine datastore
+class Key:
+    def __init__(self, value):
+        self.value = value
+
+    def urlsafe(self):
+        return self.value
+
+class Picture:
+    stored = {}
+
+    def __init__(self, parent=None, id=None):
+        self.key = None
+        self.histogram = None
+
+    @staticmethod
+    def picture_key(username):
+        return Key(username)
+
+    @staticmethod
+    def get_by_urlsafe(value):
+        return Picture.stored.get(value)
+
+    def put(self):
+        self.key = Key("picture-%d" % len(Picture.stored))
+        Picture.stored[self.key.urlsafe()] = self
+        return self.key
+
+# ImageOperator with the stand-in model and blobs in memory, only ever loaded in a child process
+def load_operator():
+    model = imp.new_module("model")
+    model.Picture = Picture
+    sys.modules["model"] = model
+    import storage
+    storage.backend = storage.MemoryStorage()
+    from image_operator import ImageOperator
+    return ImageOperator
+
+def process(operator, content):
+    return operator.process("benchmark", content)
+
+# Decoding and rendering without storing anything, which process is compared against
+def render_only(operator, content):
+    image = operator.decode(content)
+    operator.render_derivatives(image)
+    return operator.render_palette(content, image=image)
+
+PIPELINES = {"process": process, "render": render_only}
+
+def run_child(name, content, queue):
+    try:
+        operator = load_operator()
+        start_kb = suite.peak_kb()
+        PIPELINES[name](operator, content)
+        queue.put({"peak_growth_kb": suite.peak_kb() - start_kb})
+    except Exception, e:
+        queue.put({"error": "%s: %s" % (e.__class__.__name__, e)})
+        raise
+
+def measure(name, content):
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_child, args=(name, content, queue))
+    child.start()
+    result = queue.get()
+    child.join()
+    if "error" in result:
+        raise RuntimeError("%s pipeline failed with %s" % (name, result["error"]))
+    return result["peak_growth_kb"]
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Measure the peak memory ImageOperator.process adds to rendering.")
+    parser.add_argument("--size", choices=sorted(suite.SIZES), default="20mp")
+    parser.add_argument("--kind", choices=suite.KINDS, default="noise")
+    parser.add_argument("--max-copies", type=float, default=0.5,
+                        help="allowed peak growth of process on top of rendering, in uploads")
+    args = parser.parse_args(argv)
+
+    content = suite.generate_jpeg(args.kind, suite.SIZES[args.size])
+    upload_kb = len(content) / 1024.0
+    print "upload %.0f KB" % upload_kb
+    render_kb = measure("render", content)
+    print "render   peak +%d KB" % render_kb
+    growth = measure("process", content)
+    copies = (growth - render_kb) / upload_kb
+    print "process  peak +%d KB (%.2f uploads on top of rendering)" % (growth, copies)
+    if copies > args.max_copies:
+        print >> sys.stderr, "process needs %.2f uploads on top of rendering, more than %.2f" % (
+                copies, args.max_copies)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Times imaging.ColorUtil.generate_color_panes against the per-pixel loop it replaced
+# Exits with a non-zero status if rendering a pane takes longer than the limit, so it can guard regressions
+import sys
+import time
+
+import Image
+import imaging
+
+COLORS = ((22, 217, 53), (35, 221, 151), (226, 90, 201), (220, 29, 101), (25, 29, 53))
+SIZES = ((640, 360), (1280, 720), (97, 53))
+# Rendering a 640x360 pane should stay well under a millisecond
+LIMIT = 0.001
+
+
+# The per-pixel renderer from before the rectangle fills, kept here for comparison
+def legacy_color_panes(colors, size=(640, 360)):
+    display = Image.new("RGB", size)
+    display_pixmap = display.load()
+    num_colors = len(colors)
+    bar_width = int(size[0] / num_colors)
+    for i in range(num_colors):
+        for x in range((i * bar_width), ((i+1) * bar_width)):
+            for y in range(size[1]):
+                display_pixmap[x, y] = colors[i]
+    return display
+
+# Best time out of a number of repeats
+def best_time(function, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best
+
+def main():
+    failed = False
+    print "%10s %12s %12s" % ("size", "legacy (ms)", "fill (ms)")
+    for size in SIZES:
+        legacy = legacy_color_panes(COLORS, size)
+        filled = imaging.ColorUtil.generate_color_panes(COLORS, size)
+        if list(legacy.getdata()) != list(filled.getdata()):
+            print "Rendered panes differ at", size
+            failed = True
+        legacy_time = best_time(lambda: legacy_color_panes(COLORS, size), 3)
+        fill_time = best_time(lambda: imaging.ColorUtil.generate_color_panes(COLORS, size), 50)
+        print "%10s %12.3f %12.3f" % ("%dx%d" % size, legacy_time * 1000, fill_time * 1000)
+        if size == (640, 360) and fill_time > LIMIT:
+            print "Pane rendering took %.3f ms, the limit is %.3f ms" % (fill_time * 1000, LIMIT * 1000)
+            failed = True
+    return failed
+
+if __name__ == "__main__":
+    sys.exit(1 if main() else 0)
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Compares imaging.PriorityMap, a heap with lazy deletion, against the structures it replaced:
+# the original linear list, and the sorted list kept in order with bisect that came after it
+# Each run fills a map with one entry per bucket, the way PopMap.compute and ColorUtil.map_to_hsv do,
+# then copies it, removes a few entries and pops a few more, and reads the top entries and the whole data
+# The entries are random and synthetic, not taken from real photos. At the default PopMap.BITS of 2 there are
+# only 64 buckets, where every version takes a fraction of a millisecond, so the gain only shows with more bits
+# On one machine the heap was about 0.6x the speed of the sorted list up to 4096 entries, where memmoves are
+# cheap and its bookkeeping isn't, 2x at 32768 (every bucket of 5 bits per channel) and 11x at 262144
+#
+# python -m benchmarks.priority_map [entries ...]
+import bisect
+import random
+import sys
+import time
+
+import imaging
+
+
+# The list based PriorityMap from before the sorted index, kept here for comparison
+class LinearPriorityMap:
+    def __init__(self, data=None):
+        if data == None:
+            self.data = []
+        else:
+            self.data = data
+    def add(self, value, item):
+        inserted = False
+        for i in range(len(self.data)):
+            if self.data[0][0] < value:
+                self.data.insert(i, (value, item))
+                inserted = True
+        if inserted == False:
+            self.data.append((value, item))
+    def remove(self, value):
+        for i in range(len(self.data)):
+            if self.data[i][1] == value:
+                del self.data[i]
+                return
+    def pop(self):
+        return self.data.pop(0)
+    def top(self, count):
+        return self.data[:count]
+    def pm_copy(self):
+        return LinearPriorityMap(list(self.data))
+
+
+# The sorted list PriorityMap that came next, where bisect finds positions but insert and del still
+# shift the lists, kept here for comparison
+class SortedListPriorityMap:
+    def __init__(self):
+        self.data = []
+        self.keys = []
+    def add(self, value, item):
+        position = bisect.bisect_right(self.keys, -value)
+        self.keys.insert(position, -value)
+        self.data.insert(position, (value, item))
+    def remove(self, value):
+        for i in range(len(self.data)):
+            if self.data[i][1] == value:
+                del self.keys[i]
+                del self.data[i]
+                return
+    def pop(self):
+        del self.keys[0]
+        return self.data.pop(0)
+    def top(self, count):
+        return self.data[:count]
+    def pm_copy(self):
+        copied = SortedListPriorityMap()
+        copied.data = list(self.data)
+        copied.keys = list(self.keys)
+        return copied
+
+
+# Bucket populations of a high entropy photo are close to uniform, with a long tail of small buckets
+def high_entropy_entries(count, seed=0):
+    rng = random.Random(seed)
+    entries = []
+    for i in range(count):
+        value = int(rng.paretovariate(1.5) * 10)
+        item = (rng.random(), rng.random(), rng.random())
+        entries.append((value, item))
+    return entries
+
+def run(cls, entries, removals, pops=5):
+    start = time.time()
+    priority_map = cls()
+    for value, item in entries:
+        priority_map.add(value, item)
+    copied = priority_map.pm_copy()
+    for value, item in removals:
+        copied.remove(item)
+    for i in range(min(pops, len(entries) - len(removals))):
+        copied.pop()
+    copied.top(5)
+    len(copied.data)
+    return time.time() - start
+
+def best_time(cls, entries, removals, repeats=3):
+    return min(run(cls, entries, removals) for i in range(repeats))
+
+def main(sizes):
+    print "%8s %12s %12s %12s %8s" % ("entries", "linear (s)", "sorted (s)", "heap (s)", "vs sorted")
+    for size in sizes:
+        entries = high_entropy_entries(size)
+        removals = random.Random(1).sample(entries, min(5, size))
+        linear = best_time(LinearPriorityMap, entries, removals, 1) if size <= 4096 else None
+        ordered = best_time(SortedListPriorityMap, entries, removals)
+        heap = best_time(imaging.PriorityMap, entries, removals)
+        print "%8d %12s %12.4f %12.4f %7.1fx" % (size, "-" if linear == None else "%.4f" % linear,
+                                                ordered, heap, ordered / max(heap, 1e-9))
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main([int(arg) for arg in sys.argv[1:]])
+    else:
+        main([64, 512, 4096, 32768, 262144])
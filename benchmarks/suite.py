@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+# Benchmark suite for the imaging pipeline
+# Every case is a synthetic image, generated the same way on every run, encoded as a JPEG the way Glass sends them.
+# Each stage of the pipeline is timed on its own (best of --repeats runs), and each case runs in a child process
+# so the growth of its peak memory can be reported.
+# Each case also reports its palette drift: how far the palettes from the default sample budget are from the
+# palettes of the unbudgeted ColorFinder, which samples the full size image every fifth pixel. It is the
+# CIE76 delta E from each color to the closest color of the other palette, averaged, for the worst scheme.
+# The budget does move palettes: on these images drift was 0 for flat ones, about 20-45 for photo-like ones
+# and up to 75 for noise, whose buckets are all close to equally popular.
+#
+# python -m benchmarks.suite --output results.json
+# python -m benchmarks.suite --baseline benchmarks/baseline.json --threshold 25
+# python -m benchmarks.suite --write-baseline benchmarks/baseline.json
+#
+# With --baseline, the exit status is non-zero if any stage got slower than the baseline by more than the threshold,
+# or if the palette drift of any case grew by more than --drift-tolerance
+# benchmarks/baseline.json comes from a single machine, whose versions are stored in it. Timings only compare
+# well against a baseline written on the same machine, so write a fresh one before comparing anywhere else
+import argparse
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
+
+import numpy
+import Image
+import imaging
+
+SIZES = {
+    "thumbnail": (160, 120),
+    "vga": (640, 480),
+    "glass": (2528, 1856),
+    "20mp": (5472, 3648),
+}
+KINDS = ("flat", "gradient", "noise", "photo")
+STAGES = ("decode", "init", "pop_map", "map_to_hsv", "complements", "panes")
+# Stages that change by less than this many seconds don't count as regressions, however big the percentage
+NOISE_FLOOR = 0.002
+# Palette drift that grows by less than this much delta E doesn't count as a regression
+DRIFT_TOLERANCE = 5.0
+
+
+def flat_image(size, rng):
+    color = rng.randint(0, 256, 3).astype(numpy.uint8)
+    return Image.new("RGB", size, tuple(int(channel) for channel in color))
+
+def gradient_image(size, rng):
+    width, height = size
+    x = numpy.linspace(0, 255, width).astype(numpy.uint8)
+    y = numpy.linspace(0, 255, height).astype(numpy.uint8)
+    pixels = numpy.empty((height, width, 3), dtype=numpy.uint8)
+    pixels[:, :, 0] = x[numpy.newaxis, :]
+    pixels[:, :, 1] = y[:, numpy.newaxis]
+    pixels[:, :, 2] = rng.randint(0, 256)
+    return Image.fromarray(pixels)
+
+def noise_image(size, rng):
+    width, height = size
+    pixels = numpy.frombuffer(rng.bytes(width * height * 3), dtype=numpy.uint8)
+    return Image.fromarray(pixels.reshape(height, width, 3))
+
+# Smooth patches of color with some grain on top, which is closer to what a camera gives than noise
+def photo_image(size, rng):
+    width, height = size
+    coarse = numpy.frombuffer(rng.bytes(12 * 9 * 3), dtype=numpy.uint8).reshape(9, 12, 3)
+    smooth = Image.fromarray(coarse).resize(size, Image.BILINEAR)
+    grain = noise_image((max(1, width // 4), max(1, height // 4)), rng).resize(size, Image.NEAREST)
+    return Image.blend(smooth, grain, 0.15)
+
+GENERATORS = {"flat": flat_image, "gradient": gradient_image, "noise": noise_image, "photo": photo_image}
+
+# Same image every time for the same kind and size
+def generate_jpeg(kind, size):
+    rng = numpy.random.RandomState(sorted(GENERATORS).index(kind) * 1000 + sorted(SIZES.values()).index(size))
+    output = io.BytesIO()
+    GENERATORS[kind](size, rng).save(output, format="JPEG", quality=90)
+    return output.getvalue()
+
+def peak_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+# Best time out of repeats, and the last result
+def best_of(repeats, function):
+    best = None
+    result = None
+    for i in range(repeats):
+        start = time.time()
+        result = function()
+        elapsed = time.time() - start
+        if best == None or elapsed < best:
+            best = elapsed
+    return best, result
+
+# Mean distance from each color of one palette to the closest color of the other, both ways, in CIE76 delta E
+def palette_distance(first, second):
+    first = [imaging.ColorUtil.convert_to_lab(color) for color in first]
+    second = [imaging.ColorUtil.convert_to_lab(color) for color in second]
+    distances = [min(imaging.ColorUtil.delta_e(color, other) for other in second) for color in first]
+    distances += [min(imaging.ColorUtil.delta_e(color, other) for other in first) for color in second]
+    return sum(distances) / len(distances)
+
+# Worst palette_distance over the schemes, between the default sample budget and no budget
+def palette_drift(content):
+    budgeted = imaging.ColorFinder(Image.open(io.BytesIO(content))).strategy_multi_complements()
+    full = imaging.ColorFinder(Image.open(io.BytesIO(content)), sample_budget=None).strategy_multi_complements()
+    return max(palette_distance(budgeted[scheme], full[scheme]) for scheme in budgeted)
+
+def run_case(content, repeats):
+    start_kb = peak_kb()
+    timings = {}
+    memory = {}
+
+    def stage(name, function):
+        before = peak_kb()
+        timings[name], result = best_of(repeats, function)
+        memory[name] = peak_kb() - before
+        return result
+
+    def decode():
+        image = imaging.ColorFinder.reduce_image(Image.open(io.BytesIO(content)), imaging.ColorFinder.SAMPLE_BUDGET)
+        image.load()
+        return image
+    image = stage("decode", decode)
+    cf = stage("init", lambda: imaging.ColorFinder(Image.open(io.BytesIO(content))))
+    computation = stage("pop_map", lambda: cf.compute_pop_map(image))
+    stage("map_to_hsv", lambda: imaging.ColorUtil.map_to_hsv(computation))
+    colors = stage("complements", lambda: cf.strategy_enhanced_complements())
+    stage("panes", lambda: imaging.ColorUtil.generate_color_panes(tuple(colors)))
+    peak_growth = peak_kb() - start_kb
+    return {"stages": timings, "stage_peak_growth_kb": memory, "peak_growth_kb": peak_growth,
+            "palette_drift": round(palette_drift(content), 2)}
+
+def run_case_child(content, repeats, queue):
+    try:
+        queue.put(run_case(content, repeats))
+    except Exception, e:
+        queue.put({"error": "%s: %s" % (e.__class__.__name__, e)})
+        raise
+
+# Runs a case in a fresh process, so its peak memory isn't hidden by the cases before it
+def run_isolated(content, repeats):
+    queue = multiprocessing.Queue()
+    child = multiprocessing.Process(target=run_case_child, args=(content, repeats, queue))
+    child.start()
+    result = queue.get()
+    child.join()
+    if "error" in result:
+        raise RuntimeError("Benchmark case failed with %s" % result["error"])
+    return result
+
+def run_suite(kinds, sizes, repeats):
+    cases = {}
+    for size_name in sizes:
+        for kind in kinds:
+            name = "%s-%s" % (kind, size_name)
+            content = generate_jpeg(kind, SIZES[size_name])
+            result = run_isolated(content, repeats)
+            result["size"] = list(SIZES[size_name])
+            result["jpeg_bytes"] = len(content)
+            cases[name] = result
+            print >> sys.stderr, "%-18s %s peak +%d KB drift %.1f" % (name, " ".join(
+                "%s=%.1fms" % (stage, result["stages"][stage] * 1000) for stage in STAGES), result["peak_growth_kb"],
+                result["palette_drift"])
+    return {
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "machine": platform.machine(),
+        "cases": cases,
+    }
+
+# Lists the stages that got slower than the baseline by more than threshold percent,
+# and the cases whose palette drift grew by more than drift_tolerance, as a "palette_drift" stage
+def find_regressions(results, baseline, threshold, drift_tolerance=DRIFT_TOLERANCE):
+    regressions = []
+    for name, case in results["cases"].items():
+        if name not in baseline["cases"]:
+            continue
+        previous_drift = baseline["cases"][name].get("palette_drift")
+        if previous_drift != None and case["palette_drift"] > previous_drift + drift_tolerance:
+            regressions.append((name, "palette_drift", previous_drift, case["palette_drift"]))
+        for stage, elapsed in case["stages"].items():
+            previous = baseline["cases"][name]["stages"].get(stage)
+            if previous == None:
+                continue
+            if elapsed - previous > NOISE_FLOOR and elapsed > previous * (1 + threshold / 100.0):
+                regressions.append((name, stage, previous, elapsed))
+    return regressions
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Time each stage of the imaging pipeline on synthetic images.")
+    parser.add_argument("--kinds", nargs="+", choices=KINDS, default=list(KINDS))
+    parser.add_argument("--sizes", nargs="+", choices=sorted(SIZES), default=["thumbnail", "vga", "glass", "20mp"])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    parser.add_argument("--baseline", help="JSON results from an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=20.0, help="allowed slowdown per stage, in percent")
+    parser.add_argument("--drift-tolerance", type=float, default=DRIFT_TOLERANCE,
+                        help="allowed growth of the palette drift of each case, in delta E")
+    parser.add_argument("--write-baseline", metavar="PATH", help="file to store these results in as a new baseline")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.kinds, args.sizes, args.repeats)
+    serialized = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(serialized + "\n")
+    else:
+        print serialized
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.threshold, args.drift_tolerance)
+        for name, stage, previous, current in regressions:
+            if stage == "palette_drift":
+                print >> sys.stderr, "%s palette drift grew: %.1f -> %.1f" % (name, previous, current)
+            else:
+                print >> sys.stderr, "%s %s regressed: %.2fms -> %.2fms" % (name, stage, previous * 1000, current * 1000)
+    # written after the comparison, so the same file can be compared against and then replaced
+    if args.write_baseline:
+        with open(args.write_baseline, "w") as f:
+            f.write(serialized + "\n")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,12 +1,27 @@
 import urllib
-from google.appengine.ext import blobstore
 from google.appengine.ext.webapp import blobstore_handlers
 
+import storage
+
+# Blobs never change once they are written, so they can be cached forever, and a request that
+# already has one gets a 304, see storage.not_modified
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Serves originals and palettes from whichever storage backend the app uses
 class ServeHandler(blobstore_handlers.BlobstoreDownloadHandler):
   def get(self, resource):
     resource = str(urllib.unquote(resource))
-    blob_info = blobstore.BlobInfo.get(resource)
-    self.send_blob(blob_info)
+    etag = '"%s"' % resource
+    backend = storage.get_backend()
+    if storage.not_modified(backend, resource, self.request.headers):
+      self.response.status = 304
+      self.response.headers['ETag'] = etag
+      self.response.headers['Cache-Control'] = CACHE_CONTROL
+      return
+    found = backend.serve(self, resource)
+    if found and self.response.status_int in (200, 206):
+      self.response.headers['ETag'] = etag
+      self.response.headers['Cache-Control'] = CACHE_CONTROL
 
 BLOB_ROUTES = [
     ('/serve/([^/]+)?', ServeHandler)
@@ -0,0 +1,145 @@
+import cPickle
+import sys
+import threading
+from collections import OrderedDict
+
+
+# Bytes of memory a value takes, counting the lists and tuples in it and everything they hold
+# Small ints and other values Python shares get counted each time, so this errs on the high side
+def deep_sizeof(value):
+    size = sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        size += sum(deep_sizeof(item) for item in value)
+    return size
+
+
+# In-process least recently used cache, bounded by the total size of its values
+# sizeof gives the size in bytes of a value, len by default
+# Instances are threadsafe, since the app runs with threadsafe: true
+class LRUCache:
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            size, value = self.entries.pop(key)
+            self.entries[key] = (size, value)
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[0]
+            # values bigger than the whole cache aren't worth evicting everything for
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (size, value)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                evicted_key, (evicted_size, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[0]
+
+
+# Stand-in for the parts of the App Engine memcache API used here, for tests and running outside App Engine
+# Values are pickled like memcache does, so callers can't share mutable values by accident
+# Expiry times are accepted but ignored
+class LocalMemcache:
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, namespace=None):
+        with self.lock:
+            value = self.values.get((namespace, key))
+        if value == None:
+            return None
+        return cPickle.loads(value)
+
+    def get_multi(self, keys, namespace=None):
+        found = {}
+        for key in keys:
+            value = self.get(key, namespace=namespace)
+            if value != None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, time=0, namespace=None):
+        with self.lock:
+            self.values[(namespace, key)] = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return True
+
+    # Sets the value only if there isn't one, returns whether it did
+    def add(self, key, value, time=0, namespace=None):
+        with self.lock:
+            if (namespace, key) in self.values:
+                return False
+            self.values[(namespace, key)] = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return True
+
+    def delete(self, key, namespace=None):
+        with self.lock:
+            self.values.pop((namespace, key), None)
+        return 2
+
+    def incr(self, key, delta=1, namespace=None, initial_value=None):
+        with self.lock:
+            value = self.values.get((namespace, key))
+            if value == None:
+                if initial_value == None:
+                    return None
+                current = initial_value
+            else:
+                current = cPickle.loads(value)
+            current += delta
+            self.values[(namespace, key)] = cPickle.dumps(current, cPickle.HIGHEST_PROTOCOL)
+            return current
+
+
+# App Engine memcache when it is available, a LocalMemcache otherwise
+def memcache_client():
+    try:
+        from google.appengine.api import memcache
+    except ImportError:
+        return LocalMemcache()
+    return memcache
+
+
+# Two level cache: an LRUCache in this instance, in front of memcache shared by all instances
+# Values found in memcache are copied in to the local cache
+class TieredCache:
+    def __init__(self, namespace, local, shared):
+        self.namespace = namespace
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value != None:
+            return value
+        value = self.shared.get(key, namespace=self.namespace)
+        if value != None:
+            self.local.put(key, value)
+        return value
+
+    def set(self, key, value, time=0):
+        self.local.put(key, value)
+        self.shared.set(key, value, time=time, namespace=self.namespace)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key, namespace=self.namespace)
@@ -0,0 +1,34 @@
+import os
+
+import cache
+from model import Picture
+
+# Each user's most recent pictures, and the page showing them, kept in memcache so page views
+# don't need a datastore query. ImageOperator.process invalidates both when it stores a picture
+# Entries also expire after CACHE_SECONDS, which bounds how long a page view that raced an upload
+# can put back a list without the new picture
+RECENT_COUNT = 3
+CACHE_SECONDS = 10 * 60
+# Pages rendered by one version of the app aren't used by another, in case the template changed
+NAMESPACE = "gallery-%s" % os.environ.get("CURRENT_VERSION_ID", "")
+
+shared = cache.memcache_client()
+
+def recent_pictures(owner):
+    pictures = shared.get("pictures:" + owner, namespace=NAMESPACE)
+    if pictures == None:
+        pictures = Picture.query(ancestor=Picture.picture_key(owner)).order(-Picture.date).fetch(RECENT_COUNT)
+        shared.set("pictures:" + owner, pictures, time=CACHE_SECONDS, namespace=NAMESPACE)
+    return pictures
+
+# HTML of owner's page, render is called with their recent pictures when it isn't cached
+def page(owner, render):
+    html = shared.get("page:" + owner, namespace=NAMESPACE)
+    if html == None:
+        html = render(recent_pictures(owner))
+        shared.set("page:" + owner, html, time=CACHE_SECONDS, namespace=NAMESPACE)
+    return html
+
+def invalidate(owner):
+    shared.delete("pictures:" + owner, namespace=NAMESPACE)
+    shared.delete("page:" + owner, namespace=NAMESPACE)
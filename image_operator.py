@@ -1,42 +1,213 @@
 from __future__ import with_statement
-import io
-import StringIO
+import cStringIO
+import logging
 from model import Picture
 import Image
+import cache
+import gallery
 import imaging
-from google.appengine.ext import blobstore
-from google.appengine.api import files
+import perceptual
+import storage
+import timing
+
+# Rendered palettes are cached by the content of the upload and how the palette was rendered,
+# so re-sharing the same photo or submitting the form twice skips decoding and computing it again
+# Each entry is the palette JPEG, its colors and the histogram, and all of them count against the size
+PALETTE_CACHE_BYTES = 8 * 1024 * 1024
+palette_cache = cache.TieredCache("palettes",
+        cache.LRUCache(PALETTE_CACHE_BYTES, sizeof=cache.deep_sizeof),
+        cache.memcache_client())
+# Photos that look the same but aren't byte for byte identical, like the ones Glass re-encodes,
+# are found by perceptual hash, and get their palette from the stored histogram of the earlier Picture
+near_duplicates = perceptual.NearDuplicateIndex(cache.memcache_client())
+# The derivative blob keys, widths and perceptual hash of each upload, by its owner and content, so the same
+# user uploading the same photo again reuses the stored derivatives instead of decoding it
+# Blobs are never deleted, so that user's Pictures can share them
+DERIVATIVE_CACHE_ENTRIES = 1024
+derivative_cache = cache.TieredCache("derivatives",
+        cache.LRUCache(DERIVATIVE_CACHE_ENTRIES, sizeof=lambda stored: 1),
+        cache.memcache_client())
+
+# Raised for a stored Picture whose original can't be read, when it has no histogram to make palettes from
+class MissingOriginal(Exception):
+    pass
+
+# Raised for an upload that PIL can't decode, which will fail the same way however many times it is tried
+class UndecodableImage(Exception):
+    pass
+
+# Uploads can be several megabytes, so each artifact is kept as a single str, or the list of chunks it was
+# downloaded in, for the whole request and never copied. Decoders and uploaders read a str through cStringIO,
+# which wraps it read-only without copying it, and chunks through a storage.ChunkReader.
+# Blob writes are handed the data itself
+def reader(data):
+    if isinstance(data, list):
+        return storage.ChunkReader(data)
+    return cStringIO.StringIO(data)
 
 class ImageOperator:
+    # Downscaled copies of each upload for the gallery, name -> width
+    DERIVATIVES = [("thumbnail", 320), ("medium", 1024)]
+    DERIVATIVE_QUALITY = 85
+
+    # Bump this when imaging changes the palettes it produces, so older cached palettes aren't used
+    RENDER_VERSION = 3
+
+    @staticmethod
+    def palette_key(digest, scheme, size):
+        return "%s:%s:%dx%d:v%d" % (digest, scheme, size[0], size[1], ImageOperator.RENDER_VERSION)
+
+    @staticmethod
+    def derivatives_key(owner, digest):
+        sizes = "-".join("%s%d" % derivative for derivative in ImageOperator.DERIVATIVES)
+        return "%s:%s:%s:q%d" % (owner, digest, sizes, ImageOperator.DERIVATIVE_QUALITY)
+
+    # Returns the palette JPEG, its colors and the histogram of an uploaded image
+    # With an owner and the perceptual hash of the upload, that owner's near-duplicate Pictures are reused
+    # digest is the storage.data_digest of content, and image its ImageOperator.decode, if the caller already has them
+    @staticmethod
+    def render_palette(content, scheme="TRIAD", size=(640, 360), owner=None, hashed=None, digest=None, image=None):
+        if digest == None:
+            digest = storage.data_digest(content)
+        key = ImageOperator.palette_key(digest, scheme, size)
+        with timing.span("palette_cache"):
+            rendered = palette_cache.get(key)
+        if rendered != None:
+            return rendered
+        if owner != None and hashed != None:
+            with timing.span("near_duplicate"):
+                similar = near_duplicates.find(owner, hashed)
+                picture = similar and Picture.get_by_urlsafe(similar)
+            if picture and picture.histogram:
+                # not cached: the key only covers the bytes of this upload, so caching the earlier Picture's
+                # palette under it would hand that palette to anyone else who uploads the same bytes
+                return ImageOperator.repalette(picture, scheme, size) + (picture.histogram,)
+        if image == None:
+            image = ImageOperator.decode(content)
+        cf = imaging.ColorFinder(image)
+        rendered = ImageOperator.render_colors(cf, scheme, size) + (cf.dump_histogram(),)
+        palette_cache.set(key, rendered)
+        return rendered
 
+    # Palette image and colors from a ColorFinder, image_format is a PIL format name
     @staticmethod
-    def process(owner, content):
-        im_data = io.BytesIO(content)
-        im_copy = io.BytesIO(content)
-        im = Image.open(im_data)
-        cf = imaging.ColorFinder(im)
-        top = imaging.ColorUtil.generate_color_panes(tuple(cf.strategy_enhanced_complements()))
-        output = StringIO.StringIO()
-        top.save(output, format="JPEG")
-        palette = io.BytesIO(output.getvalue())
-        palette_copy = io.BytesIO(output.getvalue())
-        output.close()
+    def render_colors(cf, scheme="TRIAD", size=(640, 360), image_format="JPEG"):
+        with timing.span("strategy"):
+            colors = cf.strategy_enhanced_complements(complement_scheme=scheme)
+        with timing.span("panes"):
+            top = imaging.ColorUtil.generate_color_panes(tuple(colors), size)
+        with timing.span("encode") as span:
+            output = cStringIO.StringIO()
+            top.save(output, format=image_format)
+            palette_data = output.getvalue()
+            output.close()
+            span.nbytes = len(palette_data)
+        return (palette_data, colors)
 
-        upload = Picture(parent=Picture.picture_key(owner))
+    # ColorFinder for a stored Picture, from its histogram when it has one
+    # Pictures from before histograms were stored, or whose histogram is damaged, get their original decoded again
+    @staticmethod
+    def finder(picture):
+        if picture.histogram:
+            try:
+                with timing.span("load_histogram", len(picture.histogram)):
+                    return imaging.StoredColorFinder(picture.histogram)
+            except ValueError, e:
+                logging.warning("Decoding the original of a picture with a bad histogram: %s", e)
+        content = picture.picture_data()
+        if content == None:
+            raise MissingOriginal(picture.picture)
+        return imaging.ColorFinder(ImageOperator.decode(content))
+
+    # Palette image and colors of a stored Picture, in any scheme, size and format
+    @staticmethod
+    def repalette(picture, scheme="TRIAD", size=(640, 360), image_format="JPEG"):
+        return ImageOperator.render_colors(ImageOperator.finder(picture), scheme, size, image_format)
+
+    # Decodes an upload at the size of the biggest derivative, which its derivatives, perceptual hash and
+    # palettes are all made from, so an upload is only decoded once
+    # JPEGs are decoded straight to the smallest of 1/2, 1/4 or 1/8 scale that is still big enough
+    # Raises UndecodableImage for an upload PIL can't decode
+    @staticmethod
+    def decode(content):
+        try:
+            im = Image.open(reader(content))
+            width = max(derivative[1] for derivative in ImageOperator.DERIVATIVES)
+            if im.size[0] > width:
+                im.draft(im.mode, (width, max(1, im.size[1] * width // im.size[0])))
+            with timing.span("upload_decode"):
+                if im.mode not in ("RGB", "L"):
+                    im = im.convert("RGB")
+                im.load()
+        except IOError, e:
+            raise UndecodableImage(str(e))
+        return im
+
+    # (name, JPEG, width) of each derivative of a decoded upload
+    # Images are never scaled up, so a derivative of a small upload can be narrower than its width
+    @staticmethod
+    def render_derivatives(im):
+        derivatives = []
+        for name, width in ImageOperator.DERIVATIVES:
+            with timing.span("derivative_encode") as span:
+                if im.size[0] > width:
+                    scaled = im.resize((width, max(1, im.size[1] * width // im.size[0])), Image.ANTIALIAS)
+                else:
+                    scaled = im
+                output = cStringIO.StringIO()
+                scaled.save(output, format="JPEG", quality=ImageOperator.DERIVATIVE_QUALITY)
+                derivatives.append((name, output.getvalue(), scaled.size[0]))
+                output.close()
+                span.nbytes = len(derivatives[-1][1])
+        return derivatives
+
+    # Stores an upload, its derivatives and its palette, returns a read-only stream of the palette JPEG
+    # content is a str, or a list of str chunks that are stored without being joined
+    # source names where the upload came from, like a timeline item. The Picture of an upload with a source
+    # is stored under it, and processing the same source again returns the stored palette without storing
+    # anything. Raises UndecodableImage for an upload PIL can't decode
+    @staticmethod
+    def process(owner, content, scheme="TRIAD", size=(640, 360), source=None):
+        if source != None:
+            existing = Picture.source_key(owner, source).get()
+            if existing != None:
+                return reader(existing.palette_data())
+        digest = storage.data_digest(content)
+        derivatives_key = ImageOperator.derivatives_key(owner, digest)
+        with timing.span("derivative_cache"):
+            stored = derivative_cache.get(derivatives_key)
+        if stored != None:
+            hashed, derivative_keys = stored
+            derivatives = []
+            image = None
+        else:
+            # one decode for the derivatives, the perceptual hash and the palette
+            image = ImageOperator.decode(content)
+            derivatives = ImageOperator.render_derivatives(image)
+            with timing.span("perceptual_hash"):
+                hashed = perceptual.dhash(image)
+        palette_data, colors, histogram = ImageOperator.render_palette(content, scheme, size, owner, hashed, digest, image)
+        # the decoded image isn't held on to while the blobs are written
+        image = None
+
+        upload = Picture(parent=Picture.picture_key(owner), id=source)
         upload.owner = owner
-        file_name = files.blobstore.create(mime_type='image/jpeg')
-        with files.open(file_name, 'a') as f:
-            f.write(im_copy.read())
-        files.finalize(file_name)
-        picture_blob_key = files.blobstore.get_blob_key(file_name)
-        upload.picture = str(picture_blob_key)
-
-        palette_name = files.blobstore.create(mime_type='image/jpeg')
-        with files.open(palette_name, 'a') as f:
-            f.write(palette_copy.read())
-        files.finalize(palette_name)
-        palette_blob_key = files.blobstore.get_blob_key(palette_name)
-        upload.palette = str(palette_blob_key)
-        upload.put()
-
-        return palette
+        # the original, the derivatives and the palette are written at the same time
+        blobs = [(content, 'image/jpeg'), (palette_data, 'image/jpeg')]
+        blobs.extend((data, 'image/jpeg') for name, data, width in derivatives)
+        with timing.span("blob_writes", sum(storage.data_length(blob[0]) for blob in blobs)):
+            keys = storage.write_all(storage.get_backend(), blobs)
+        upload.picture, upload.palette = keys[:2]
+        if stored == None:
+            derivative_keys = [(name, key, width) for (name, data, width), key in zip(derivatives, keys[2:])]
+            derivative_cache.set(derivatives_key, (hashed, derivative_keys))
+        for name, key, width in derivative_keys:
+            setattr(upload, name, key)
+            setattr(upload, name + "_width", width)
+        upload.histogram = histogram
+        with timing.span("datastore_put"):
+            upload.put()
+        gallery.invalidate(owner)
+        near_duplicates.add(owner, hashed, upload.key.urlsafe())
+
+        return reader(palette_data)
@@ -1,81 +1,362 @@
 #!/usr/bin/env python
 import Image
-import ImageStat
+import array
+import heapq
 import colorsys
+import struct
 import sys
 import math
+import timing
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+hsv_lut_table = None
+srgb_linear_table = None
 
 # Class to keep track of data with an arbitrary value attached to it
 # Provide a value and some data to the add function, and the item will be inserted in to the structure
-# Structure is always kept in order according to the first value in each tuple
+# data is always in descending order according to the first value in each tuple,
+# with items of equal value kept in insertion order
+# Entries are kept in a binary heap of (-value, insertion number, value, item), so add and pop are O(log n)
+# remove only marks an entry as removed, found through index from each item to its entries, and the heap
+# drops removed entries as they come up or when more than half of it has been removed
+# data sorts the heap once after a change and keeps the sorted list until the next one, so top is a slice
 class PriorityMap:
     def __init__(self, data=None):
-        if data == None:
-            self.data = []
-        else:
-            self.data = data
+        self.heap = []
+        # item key -> tuple of its entries, replaced rather than changed so copies can share them
+        self.index = {}
+        self.removed = set()
+        self.inserted = 0
+        self.sorted = None
+        for value, item in data or []:
+            self.heap.append(self.entry(value, item))
+        heapq.heapify(self.heap)
     def __str__(self):
         return str(self.data)
+    def __len__(self):
+        return len(self.heap) - len(self.removed)
+    # Items are often lists of channel values, which can't be used as dict keys
+    @staticmethod
+    def item_key(item):
+        if isinstance(item, list):
+            return tuple(item)
+        return item
+    # New heap entry for an item, added to index
+    def entry(self, value, item):
+        entry = (-value, self.inserted, value, item)
+        self.inserted += 1
+        key = PriorityMap.item_key(item)
+        self.index[key] = self.index.get(key, ()) + (entry,)
+        return entry
+    def unindex(self, entry):
+        key = PriorityMap.item_key(entry[3])
+        remaining = tuple(other for other in self.index[key] if other is not entry)
+        if remaining:
+            self.index[key] = remaining
+        else:
+            del self.index[key]
     def add(self, value, item):
-        inserted = False
-        for i in range(len(self.data)):
-            if self.data[0][0] < value:
-                self.data.insert(i, (value, item))
-                inserted = True
-        if inserted == False:
-            self.data.append((value, item))
+        heapq.heappush(self.heap, self.entry(value, item))
+        self.sorted = None
+    # Removes the first entry in data with the given item
     def remove(self, value):
-        for i in range(len(self.data)):
-            if self.data[i][1] == value:
-                del self.data[i]
-                return
+        entries = self.index.get(PriorityMap.item_key(value))
+        if not entries:
+            return
+        entry = min(entries)
+        self.unindex(entry)
+        self.removed.add(entry[1])
+        self.sorted = None
+        if len(self.removed) * 2 > len(self.heap):
+            self.heap = [entry for entry in self.heap if entry[1] not in self.removed]
+            heapq.heapify(self.heap)
+            self.removed = set()
     def pop(self):
-        return self.data.pop(0)
+        while self.heap:
+            entry = heapq.heappop(self.heap)
+            if entry[1] in self.removed:
+                self.removed.discard(entry[1])
+                continue
+            self.unindex(entry)
+            self.sorted = None
+            return (entry[2], entry[3])
+        raise IndexError("pop from an empty PriorityMap")
+    # (value, item) tuples of every entry, highest value first
+    @property
+    def data(self):
+        if self.sorted is None:
+            self.sorted = [(entry[2], entry[3]) for entry in sorted(self.heap) if entry[1] not in self.removed]
+        return self.sorted
+    # The count entries with the highest values
+    def top(self, count):
+        return self.data[:count]
+    def pm_copy(self):
+        copied = PriorityMap()
+        copied.heap = list(self.heap)
+        copied.index = dict(self.index)
+        copied.removed = set(self.removed)
+        copied.inserted = self.inserted
+        copied.sorted = self.sorted
+        return copied
+
+
+# Colormap of HSV colors held as parallel arrays, used when numpy is available
+# Entries keep the order they were given in, and removed entries are switched off in the active mask
+# so copies can share everything else
+class HSVColorMap:
+    # counts is an array of n counts, colors an (n, 3) array of HSV colors
+    # rgb can give the RGB colors they were converted from, otherwise they're converted back when needed
+    def __init__(self, counts, colors, rgb=None):
+        self.counts = numpy.asarray(counts, dtype=numpy.float64)
+        self.rgb = rgb
+        self.lab_colors = None
+        colors = numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 3)
+        self.h = colors[:, 0]
+        self.s = colors[:, 1]
+        self.v = colors[:, 2]
+        self.items = [tuple(color) for color in colors.tolist()]
+        self.active = numpy.ones(len(self.items), dtype=bool)
+        self.index = {}
+        for i in range(len(self.items)):
+            self.index.setdefault(self.items[i], []).append(i)
+    # Builds a colormap from (count, color) entries
+    @staticmethod
+    def from_entries(entries):
+        return HSVColorMap([entry[0] for entry in entries], [tuple(entry[1]) for entry in entries])
+    def __str__(self):
+        return str(self.data)
+    def __len__(self):
+        return int(self.active.sum())
+    # (count, color) tuples of the entries that haven't been removed, like PriorityMap.data
+    @property
+    def data(self):
+        return [(self.counts[i], self.items[i]) for i in numpy.flatnonzero(self.active)]
+    def remove(self, value):
+        for i in self.index.get(tuple(value), []):
+            if self.active[i]:
+                self.active[i] = False
+                return
+    def top(self, count):
+        return self.data[:count]
+    # CIELAB colors of every entry as a (3, n) array of L, a and b rows, converted the first time they're needed
+    def lab(self):
+        if self.lab_colors is None:
+            if self.rgb is None:
+                self.rgb = numpy.array([ColorUtil.convert_to_rgb(item) for item in self.items]).reshape(-1, 3)
+            self.lab_colors = numpy.ascontiguousarray(ColorUtil.convert_array_to_lab(self.rgb).T)
+        return self.lab_colors
     def pm_copy(self):
-        return PriorityMap(list(self.data))
+        copied = HSVColorMap([], [])
+        copied.__dict__.update(self.__dict__)
+        copied.active = self.active.copy()
+        return copied
 
 
 # Class to keep track of buckets of colors
-# Each bucket covers 8x8x8 colors, for a total of 512 colors per bucket
+# Buckets keep the top <bits> bits of each channel. The default of 2 bits gives 4x4x4 buckets,
+# each 64 values wide on every channel
+# Only buckets that pixels land in are stored, as [count, red total, green total, blue total]
 class PopMap:
-    def __init__(self):
+    BITS = 2
+
+    def __init__(self, bits=BITS):
+        self.bits = bits
         self.buckets = {}
-        i = 0
-        while i < 256:
-            self.buckets[i] = {}
-            j = 0
-            while j < 256:
-                self.buckets[i][j] = {}
-                k = 0
-                while k < 256:
-                    self.buckets[i][j][k] = []
-                    k = k + 8
-                j = j + 8
-            i = i + 8
     def add(self, colors):
-        bucket = []
-        for color in colors:
-            nearby = math.floor(color/8.0)
-            bucket.append(int(nearby - (nearby % 8)))
-        self.buckets[bucket[0]][bucket[1]][bucket[2]].append(colors)
+        shift = 8 - self.bits
+        bucket = (colors[0] >> shift, colors[1] >> shift, colors[2] >> shift)
+        totals = self.buckets.get(bucket)
+        if totals == None:
+            self.buckets[bucket] = [1, colors[0], colors[1], colors[2]]
+        else:
+            totals[0] += 1
+            totals[1] += colors[0]
+            totals[2] += colors[1]
+            totals[3] += colors[2]
     # Return a Priority Map of (number of pixels in bucket, average color in bucket)
     def compute(self):
-        returnable = PriorityMap()
-        for rvalue, green in self.buckets.iteritems():
-            for gvalue, blue in self.buckets[rvalue].iteritems():
-                for bvalue, pixels in self.buckets[rvalue][gvalue].iteritems():
-                    count = len(pixels)
-                    totals = [0, 0, 0]
-                    if count == 0:
-                        continue
-                    for pixel in pixels:
-                        totals[0] += pixel[0]
-                        totals[1] += pixel[1]
-                        totals[2] += pixel[2]
-                    for i in range(3):
-                        totals[i] = int(totals[i] / count)
-                    returnable.add(count, totals)
-        return returnable
+        entries = []
+        for bucket in sorted(self.buckets):
+            totals = self.buckets[bucket]
+            count = totals[0]
+            entries.append((count, [totals[1] // count, totals[2] // count, totals[3] // count]))
+        return PriorityMap(entries)
+
+# Array-backed equivalent of PopMap, used when numpy is available
+# Pixels are quantized in to buckets the same way as PopMap.add, then the per-bucket pixel counts
+# and channel sums are accumulated with bincount instead of keeping every pixel around
+# Only occupied buckets are kept: keys, counts and sums are parallel arrays sorted by key
+#
+# With refine_bits set, the histogram is adaptive: each batch of pixels is bucketed at <bits> first,
+# then the pixels in the refine_cells most popular of those buckets are bucketed again at <refine_bits>
+# That separates the dominant colors finely without paying for a dense fine grid
+# A key is the bucket index shifted left one bit, with the low bit set for refined buckets
+class ArrayPopMap:
+    REFINE_CELLS = 8
+    # Grids up to this many keys are counted with a dense bincount, bigger ones are sorted instead
+    DENSE_KEYS = 1 << 16
+
+    def __init__(self, bits=PopMap.BITS, refine_bits=None, refine_cells=REFINE_CELLS):
+        self.bits = bits
+        self.refine_bits = refine_bits
+        self.refine_cells = refine_cells
+        self.keys = numpy.zeros(0, dtype=numpy.int64)
+        self.counts = numpy.zeros(0, dtype=numpy.int64)
+        self.sums = numpy.zeros((0, 3), dtype=numpy.int64)
+
+    # Bucket index of each pixel, keeping the top <bits> bits of each channel
+    @staticmethod
+    def bucket_index(pixels, bits):
+        levels = (pixels[:, :3] >> (8 - bits)).astype(numpy.int64)
+        return (levels[:, 0] << (2 * bits)) | (levels[:, 1] << bits) | levels[:, 2]
+
+    # pixels should be an (n, 3) or (n, 4) array of 8-bit channels
+    def add_pixels(self, pixels):
+        keys = ArrayPopMap.bucket_index(pixels, self.bits) << 1
+        key_space = 1 << (3 * self.bits + 1)
+        if self.refine_bits != None and len(keys) > 0:
+            cells, index, size, select = ArrayPopMap.group(keys, key_space)
+            cell_counts = numpy.bincount(index, minlength=size)[select]
+            popular = cells[numpy.argsort(-cell_counts, kind="mergesort")[:self.refine_cells]]
+            refine = numpy.in1d(keys, popular)
+            keys[refine] = (ArrayPopMap.bucket_index(pixels[refine], self.refine_bits) << 1) | 1
+            key_space = 1 << (3 * max(self.bits, self.refine_bits) + 1)
+        self.accumulate(keys, numpy.ones(len(keys), dtype=numpy.int64), pixels[:, :3], key_space)
+
+    # Groups equal keys together, returns the occupied keys, the group of each key, the number of groups,
+    # and what to select from a bincount over the groups to line it up with the occupied keys
+    @staticmethod
+    def group(keys, key_space):
+        if key_space <= ArrayPopMap.DENSE_KEYS:
+            occupied = numpy.flatnonzero(numpy.bincount(keys, minlength=key_space))
+            return occupied, keys, key_space, occupied
+        occupied, inverse = numpy.unique(keys, return_inverse=True)
+        return occupied, inverse, len(occupied), slice(None)
+
+    # Adds counts and channel sums for a batch of keys, which may repeat
+    # Counts and sums stay integers until the histogram has been decayed
+    def accumulate(self, keys, counts, sums, key_space):
+        dtype = self.counts.dtype
+        keys = numpy.concatenate((self.keys, keys))
+        counts = numpy.concatenate((self.counts, counts))
+        sums = numpy.concatenate((self.sums, sums.astype(dtype)))
+        occupied, index, size, select = ArrayPopMap.group(keys, key_space)
+        merged_sums = numpy.zeros((len(occupied), 3), dtype=dtype)
+        for channel in range(3):
+            merged_sums[:, channel] = numpy.bincount(index, weights=sums[:, channel], minlength=size)[select]
+        self.counts = numpy.bincount(index, weights=counts, minlength=size)[select].astype(dtype)
+        self.keys = occupied.astype(numpy.int64)
+        self.sums = merged_sums
+
+    # Scales the whole histogram down by factor, so older pixels count for less than new ones
+    # Buckets that fade below PRUNE_WEIGHT pixels are dropped
+    PRUNE_WEIGHT = 0.01
+    def decay(self, factor):
+        counts = self.counts * float(factor)
+        keep = counts >= ArrayPopMap.PRUNE_WEIGHT
+        self.keys = self.keys[keep]
+        self.counts = counts[keep]
+        self.sums = self.sums[keep] * float(factor)
+
+    # Same output as PopMap.compute
+    def compute(self):
+        if self.counts.dtype.kind == "f":
+            # decayed sums pick up rounding error, which shouldn't drop a whole channel value
+            averages = numpy.floor(self.sums / self.counts[:, numpy.newaxis] + 1e-6)
+        else:
+            averages = self.sums // self.counts[:, numpy.newaxis]
+        averages = averages.astype(numpy.int64).tolist()
+        counts = self.counts.tolist()
+        return PriorityMap([(counts[i], averages[i]) for i in range(len(counts))])
+
+# Finds clusters of similar colors with median cut, instead of bucketing them on a fixed grid
+# Colors near the edge of a grid bucket end up with the rest of their cluster, so popular colors
+# aren't split in two. Needs numpy. compute gives the same (count, average color) map as PopMap
+# Each split sorts the pixels of one box, so the cost is bounded by the sample size and number of clusters
+class MedianCutMap:
+    CLUSTERS = 16
+
+    def __init__(self, clusters=CLUSTERS):
+        self.clusters = clusters
+        self.batches = []
+    # pixels should be an (n, 3) or (n, 4) array of 8-bit channels
+    def add_pixels(self, pixels):
+        self.batches.append(numpy.asarray(pixels[:, :3], dtype=numpy.int64))
+    def pixels(self):
+        if len(self.batches) == 0:
+            return numpy.zeros((0, 3), dtype=numpy.int64)
+        return numpy.concatenate(self.batches)
+    # Splits the pixels in to boxes, always cutting the box with the widest channel at its median
+    def boxes(self):
+        boxes = [self.pixels()]
+        while len(boxes) < self.clusters:
+            widest = None
+            for i in range(len(boxes)):
+                if len(boxes[i]) < 2:
+                    continue
+                spread = boxes[i].max(axis=0) - boxes[i].min(axis=0)
+                if spread.max() > 0 and (widest == None or spread.max() > widest[0]):
+                    widest = (spread.max(), i, int(spread.argmax()))
+            if widest == None:
+                break
+            box = boxes.pop(widest[1])
+            box = box[numpy.argsort(box[:, widest[2]], kind="mergesort")]
+            middle = len(box) // 2
+            boxes.append(box[:middle])
+            boxes.append(box[middle:])
+        return [box for box in boxes if len(box) > 0]
+    def compute(self):
+        return MedianCutMap.box_map(self.boxes())
+    # PriorityMap of (number of pixels, average color) for groups of pixels
+    @staticmethod
+    def box_map(boxes):
+        entries = []
+        for box in boxes:
+            count = len(box)
+            entries.append((count, (box.sum(axis=0) // count).tolist()))
+        return PriorityMap(entries)
+
+# Mini-batch k-means, started from the median cut clusters
+# Every iteration moves the centers towards a random batch of the pixels, then each pixel
+# is assigned to its nearest center once at the end. iterations and batch_size bound the work
+class KMeansMap(MedianCutMap):
+    ITERATIONS = 10
+    BATCH_SIZE = 2048
+
+    def __init__(self, clusters=MedianCutMap.CLUSTERS, iterations=ITERATIONS, batch_size=BATCH_SIZE, seed=0):
+        MedianCutMap.__init__(self, clusters)
+        self.iterations = iterations
+        self.batch_size = batch_size
+        self.seed = seed
+    # Index of the nearest center for each pixel
+    @staticmethod
+    def nearest(pixels, centers):
+        distances = (centers ** 2).sum(axis=1)[numpy.newaxis, :] - 2 * numpy.dot(pixels, centers.T)
+        return distances.argmin(axis=1)
+    def compute(self):
+        pixels = self.pixels().astype(numpy.float64)
+        if len(pixels) == 0:
+            return PriorityMap()
+        centers = numpy.array([box.mean(axis=0) for box in self.boxes()])
+        seen = numpy.zeros(len(centers))
+        rng = numpy.random.RandomState(self.seed)
+        for iteration in range(self.iterations):
+            batch = pixels[rng.randint(0, len(pixels), min(self.batch_size, len(pixels)))]
+            assigned = KMeansMap.nearest(batch, centers)
+            for center in numpy.unique(assigned):
+                members = batch[assigned == center]
+                seen[center] += len(members)
+                rate = len(members) / seen[center]
+                centers[center] += rate * (members.mean(axis=0) - centers[center])
+        assigned = KMeansMap.nearest(pixels, centers)
+        pixels = pixels.astype(numpy.int64)
+        return MedianCutMap.box_map([pixels[assigned == center] for center in range(len(centers)) if (assigned == center).any()])
+
 
 # Class of color transformations
 # Given a single color, find other ones that look good with it, according to a set of schemes
@@ -85,6 +366,7 @@ class Palette:
     TRIAD = [0, 0.4166666666666667, 0.5833333333333334]
     TETRAD = [0, 0.08333333333333333, 0.5, 0.5833333333333334]
     ACC_ANALOG = [0, 0.08333333333333333, 0.5, 0.9166666666666666]
+    SCHEMES = ["MONO", "COMPLEMENT", "TRIAD", "TETRAD", "ACC_ANALOG"]
 
     # given an HSV color, give other colors that would work well
     def produce_colors(self, color, intended_scheme):
@@ -106,6 +388,16 @@ class Palette:
 
 
 class ColorUtil:
+    # Quantized colors covered by the lookup table, 5 bits per channel
+    LUT_BITS = 5
+    # Linear sRGB to CIE XYZ, and the D65 white point
+    XYZ_MATRIX = [[0.4124564, 0.3575761, 0.1804375],
+                  [0.2126729, 0.7151522, 0.0721750],
+                  [0.0193339, 0.1191920, 0.9503041]]
+    D65_WHITE = [0.95047, 1.0, 1.08883]
+    LAB_EPSILON = (6 / 29.0) ** 3
+    LAB_SLOPE = 3 * (6 / 29.0) ** 2
+
     @staticmethod
     def convert_to_hsv(color):
         return colorsys.rgb_to_hsv(color[0]/256.0, color[1]/256.0, color[2]/256.0)
@@ -115,8 +407,108 @@ class ColorUtil:
         reverted = colorsys.hsv_to_rgb(color[0], color[1], color[2])
         return (int(reverted[0] * 256), int(reverted[1] * 256), int(reverted[2] * 256))
 
+    # Same as convert_to_hsv for an (n, 3) array of RGB colors, gives the same floats as colorsys
+    @staticmethod
+    def convert_array_to_hsv(colors):
+        colors = numpy.asarray(colors, dtype=numpy.float64).reshape(-1, 3) / 256.0
+        r = colors[:, 0]
+        g = colors[:, 1]
+        b = colors[:, 2]
+        maxc = colors.max(axis=1)
+        minc = colors.min(axis=1)
+        spread = maxc - minc
+        grey = spread == 0
+        # grey colors have no hue or saturation, avoid dividing by zero for them
+        safe_maxc = numpy.where(grey, 1.0, maxc)
+        safe_spread = numpy.where(grey, 1.0, spread)
+        s = numpy.where(grey, 0.0, spread / safe_maxc)
+        rc = (maxc - r) / safe_spread
+        gc = (maxc - g) / safe_spread
+        bc = (maxc - b) / safe_spread
+        h = numpy.where(r == maxc, bc - gc, numpy.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+        h = numpy.where(grey, 0.0, (h / 6.0) % 1.0)
+        return numpy.column_stack((h, s, maxc))
+
+    # HSV colors of every quantized color, indexed by (r >> 3) << 10 | (g >> 3) << 5 | b >> 3
+    # Each entry is the conversion of the middle of its 8x8x8 cell, as float32
+    # The table is built the first time it is needed, which takes a few milliseconds, so it isn't kept on disk
+    @staticmethod
+    def hsv_lut():
+        global hsv_lut_table
+        if hsv_lut_table is None:
+            levels = 1 << ColorUtil.LUT_BITS
+            cells = numpy.arange(levels ** 3)
+            step = 256 // levels
+            centers = numpy.column_stack((cells >> (2 * ColorUtil.LUT_BITS), (cells >> ColorUtil.LUT_BITS) % levels, cells % levels)) * step + step // 2
+            hsv_lut_table = ColorUtil.convert_array_to_hsv(centers).astype("<f4")
+        return hsv_lut_table
+
+    # Looks up the HSV colors of an (n, 3) array of RGB colors at quantized precision
+    @staticmethod
+    def lookup_hsv(colors):
+        colors = numpy.asarray(colors).reshape(-1, 3).astype(numpy.intp) >> (8 - ColorUtil.LUT_BITS)
+        cells = (colors[:, 0] << (2 * ColorUtil.LUT_BITS)) | (colors[:, 1] << ColorUtil.LUT_BITS) | colors[:, 2]
+        return ColorUtil.hsv_lut()[cells].astype(numpy.float64)
+
+    # Linear light value of each 8-bit sRGB channel value
+    @staticmethod
+    def srgb_to_linear(value):
+        value = value / 255.0
+        if value <= 0.04045:
+            return value / 12.92
+        return ((value + 0.055) / 1.055) ** 2.4
+
+    @staticmethod
+    def srgb_linear_table():
+        global srgb_linear_table
+        if srgb_linear_table is None:
+            srgb_linear_table = numpy.array([ColorUtil.srgb_to_linear(value) for value in range(256)])
+        return srgb_linear_table
+
+    @staticmethod
+    def lab_f(t):
+        if t > ColorUtil.LAB_EPSILON:
+            return t ** (1 / 3.0)
+        return t / ColorUtil.LAB_SLOPE + 4 / 29.0
+
+    # CIELAB (D65) color of an RGB color with 8-bit channels
+    @staticmethod
+    def convert_to_lab(color):
+        linear = [ColorUtil.srgb_to_linear(min(max(int(channel), 0), 255)) for channel in color[:3]]
+        xyz = [sum(ColorUtil.XYZ_MATRIX[row][i] * linear[i] for i in range(3)) / ColorUtil.D65_WHITE[row] for row in range(3)]
+        fx, fy, fz = [ColorUtil.lab_f(value) for value in xyz]
+        return (116 * fy - 16, 500 * (fx - fy), 200 * (fy - fz))
+
+    # Same as convert_to_lab for an (n, 3) array of RGB colors
+    @staticmethod
+    def convert_array_to_lab(colors):
+        channels = numpy.clip(numpy.asarray(colors).reshape(-1, 3).astype(numpy.intp), 0, 255)
+        linear = ColorUtil.srgb_linear_table()[channels]
+        xyz = numpy.dot(linear, numpy.array(ColorUtil.XYZ_MATRIX).T) / numpy.array(ColorUtil.D65_WHITE)
+        f = numpy.where(xyz > ColorUtil.LAB_EPSILON, numpy.abs(xyz) ** (1 / 3.0), xyz / ColorUtil.LAB_SLOPE + 4 / 29.0)
+        return numpy.column_stack((116 * f[:, 1] - 16, 500 * (f[:, 0] - f[:, 1]), 200 * (f[:, 1] - f[:, 2])))
+
+    # CIE76 color difference between two CIELAB colors
     @staticmethod
-    def map_to_hsv(colormap):
+    def delta_e(lab1, lab2):
+        return math.sqrt(sum((lab1[i] - lab2[i]) ** 2 for i in range(3)))
+
+    # Differences between a (3, n) array of L, a and b rows and a single CIELAB color
+    @staticmethod
+    def delta_e_array(lab_rows, lab):
+        return numpy.sqrt(((lab_rows - numpy.asarray(lab)[:, numpy.newaxis]) ** 2).sum(axis=0))
+
+    # exact=False converts each bucket through the lookup table, which is faster but only
+    # as precise as the quantized colors. Averaged bucket colors need exact=True to come out the same
+    @staticmethod
+    def map_to_hsv(colormap, exact=True):
+        if numpy is not None:
+            entries = colormap.data
+            counts = [item[0] for item in entries]
+            colors = numpy.array([item[1] for item in entries], dtype=numpy.float64).reshape(-1, 3)
+            if exact:
+                return HSVColorMap(counts, ColorUtil.convert_array_to_hsv(colors), rgb=colors)
+            return HSVColorMap(counts, ColorUtil.lookup_hsv(colors), rgb=colors)
         priori = PriorityMap()
         for item in colormap.data:
             priori.add(item[0], ColorUtil.convert_to_hsv(tuple(item[1])))
@@ -124,23 +516,25 @@ class ColorUtil:
 
     @staticmethod
     def display_color(colors, size=(100, 100)):
-        display = Image.new("RGB", size)
-        display_pixmap = display.load()
-        for x in range(100):
-            for y in range(100):
-                display_pixmap[x, y] = colors
+        display = Image.new("RGB", size, tuple(colors))
         display.show()
-    
+
+    # Fills one bar per color, side by side with layout="columns" or stacked with layout="rows"
+    # Bars are all the same size, so any pixels left over past the last bar stay black
     @staticmethod
-    def generate_color_panes(colors, size=(640, 360)):
+    def generate_color_panes(colors, size=(640, 360), layout="columns"):
         display = Image.new("RGB", size)
-        display_pixmap = display.load()
         num_colors = len(colors)
-        bar_width = int(size[0] / num_colors)
-        for i in range(num_colors):
-            for x in range((i * bar_width), ((i+1) * bar_width)):
-                for y in range(size[1]):
-                    display_pixmap[x, y] = colors[i]
+        if layout == "columns":
+            bar_width = int(size[0] / num_colors)
+            for i in range(num_colors):
+                display.paste(tuple(colors[i]), ((i * bar_width), 0, ((i+1) * bar_width), size[1]))
+        elif layout == "rows":
+            bar_height = int(size[1] / num_colors)
+            for i in range(num_colors):
+                display.paste(tuple(colors[i]), (0, (i * bar_height), size[0], ((i+1) * bar_height)))
+        else:
+            raise ValueError("Unknown pane layout: %s" % layout)
         return display
 
     # Given two HSV colors, find their difference in hues
@@ -154,26 +548,135 @@ class ColorUtil:
 # Class to do the magic
 # Takes a PIL Image object
 class ColorFinder:
+    # Roughly how many pixels get sampled from each image
+    SAMPLE_BUDGET = 50000
+    # Full size images used to be sampled every fifth pixel on both axes, so each sample stood for a
+    # 5x5 block. Popularity is still measured that way so it keeps the same weight against quality
+    FULL_STRIDE = 5
+    ENGINES = ["grid", "mediancut", "kmeans"]
 
-    def __init__(self, image):
-        stat = ImageStat.Stat(image)
-        self.pixel_count = stat.count[0]
-        self.computation = self.compute_pop_map(image)
-        self.conversion = ColorUtil.map_to_hsv(self.computation)
+    # sample_budget=None samples the full size image every fifth pixel
+    # JPEGs are decoded at a reduced scale to fit the budget, which changes the size of the image passed in
+    # exact_hsv=False converts buckets through the HSV lookup table instead of their exact average color
+    # bits and refine_bits set how finely colors are bucketed, see PopMap and ArrayPopMap
+    # The adaptive refine_bits histogram needs numpy, without it colors are bucketed at <bits>
+    # engine picks how colors are grouped: "grid" buckets them, "mediancut" and "kmeans" cluster them
+    # and need numpy
+    def __init__(self, image, sample_budget=SAMPLE_BUDGET, exact_hsv=True, bits=PopMap.BITS, refine_bits=None, engine="grid"):
+        self.engine = engine
+        self.bits = bits
+        self.refine_bits = refine_bits
+        image = ColorFinder.reduce_image(image, sample_budget)
+        self.stride = ColorFinder.find_stride(image.size, sample_budget)
+        width = image.size[0]
+        height = image.size[1]
+        self.sample_count = (width // self.stride) * (height // self.stride)
+        self.pixel_count = self.sample_count * ColorFinder.FULL_STRIDE * ColorFinder.FULL_STRIDE
+        with timing.span("decode"):
+            image.load()
+        with timing.span("pop_map"):
+            self.computation = self.compute_pop_map(image)
+        with timing.span("map_to_hsv"):
+            self.conversion = ColorUtil.map_to_hsv(self.computation, exact=exact_hsv)
+
+    # Compact binary form of the histogram, for storing next to the image it came from, see StoredColorFinder
+    # An uncompressed header, then the zlib compressed counts and average colors of the occupied buckets,
+    # in the order of computation:
+    #   "LPH", version, bits, refine_bits (255 for none), engine, flags, sample count (double), bucket count
+    # Counts are little endian uint32, or doubles with FLOAT_COUNTS set in flags, averages are 3 bytes each
+    HISTOGRAM_MAGIC = "LPH"
+    HISTOGRAM_VERSION = 1
+    HISTOGRAM_HEADER = struct.Struct("<3sBBBBBdI")
+    FLOAT_COUNTS = 1
 
-    # Currently does every third pixel, for speed
+    def dump_histogram(self):
+        entries = self.computation.data
+        counts = [entry[0] for entry in entries]
+        flags = 0
+        if any(isinstance(count, float) for count in counts):
+            flags |= ColorFinder.FLOAT_COUNTS
+            count_array = array.array("d", counts)
+        else:
+            count_array = array.array("I", counts)
+        averages = array.array("B")
+        for entry in entries:
+            averages.extend(entry[1][:3])
+        if sys.byteorder != "little":
+            count_array.byteswap()
+        refine_bits = 255 if self.refine_bits == None else self.refine_bits
+        header = ColorFinder.HISTOGRAM_HEADER.pack(ColorFinder.HISTOGRAM_MAGIC, ColorFinder.HISTOGRAM_VERSION,
+                self.bits, refine_bits, ColorFinder.ENGINES.index(self.engine), flags, self.sample_count, len(entries))
+        return header + zlib.compress(count_array.tostring() + averages.tostring(), 9)
+
+    # Ask PIL for an image with about sample_budget pixels, before it gets decoded if possible
+    # JPEGs that haven't been decoded yet can be decoded straight to 1/2, 1/4 or 1/8 scale, everything else
+    # gets a nearest neighbour resize. The image passed in is never changed
+    @staticmethod
+    def reduce_image(image, sample_budget):
+        width = image.size[0]
+        height = image.size[1]
+        if sample_budget == None or width * height <= sample_budget:
+            return image
+        scale = math.sqrt(float(sample_budget) / (width * height))
+        target = (max(1, int(width * scale)), max(1, int(height * scale)))
+        if image.format == "JPEG" and image.tile and getattr(image, "fp", None) != None:
+            # draft changes the Image it is called on, so it is called on a second one over the same file
+            image.fp.seek(0)
+            reduced = Image.open(image.fp)
+            # picks the smallest scale that is still at least as big as target
+            reduced.draft(reduced.mode, target)
+            return reduced
+        return image.resize(target, Image.NEAREST)
+
+    # Distance between sampled pixels on both axes
+    @staticmethod
+    def find_stride(size, sample_budget):
+        if sample_budget == None:
+            return ColorFinder.FULL_STRIDE
+        return max(1, int(math.sqrt(float(size[0] * size[1]) / sample_budget)))
+
+    # Samples every <stride> pixels on both axes
+    # Uses the numpy histogram when it is available, and falls back to PopMap otherwise
     def compute_pop_map(self, image):
-        pop = PopMap()
+        if self.engine not in ColorFinder.ENGINES:
+            raise ValueError("Unknown color engine: %s" % self.engine)
+        if numpy is None:
+            if self.engine != "grid":
+                raise ValueError("The %s color engine needs numpy" % self.engine)
+            return self.compute_pop_map_python(image)
+        if self.engine == "mediancut":
+            pop = MedianCutMap()
+        elif self.engine == "kmeans":
+            pop = KMeansMap()
+        else:
+            pop = ArrayPopMap(self.bits, self.refine_bits)
+        pop.add_pixels(self.sample_pixels(image))
+        return pop.compute()
+
+    # (n, 3) or (n, 4) array of the pixels every <stride> pixels on both axes
+    def sample_pixels(self, image):
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGB")
+        width = image.size[0]
+        height = image.size[1]
+        stride = self.stride
+        pixels = numpy.asarray(image)
+        sampled = pixels[0:height - (height % stride):stride, 0:width - (width % stride):stride]
+        return sampled.reshape(-1, sampled.shape[2])
+
+    def compute_pop_map_python(self, image):
+        pop = PopMap(self.bits)
         pixmap = image.load()
         width = image.size[0]
         height = image.size[1]
+        stride = self.stride
         x = 0
-        while x < width - (width % 5):
+        while x < width - (width % stride):
             y = 0
-            while y < height - (height % 5):
+            while y < height - (height % stride):
                 pop.add(pixmap[x,y])
-                y += 5
-            x += 5
+                y += stride
+            x += stride
         return pop.compute()
 
     # generic function to find something that is both <quality> and popular
@@ -183,9 +686,16 @@ class ColorFinder:
     # find_quality_popular(colormap, lambda x: x[1][2])
     # example to find something close & popular:
     # find_quality_popular(colormap, lambda x: 1- ColorUtil.find_hue_difference(target_hue, x[1][0])
+    # Qualities from ColorQualities score a whole HSVColorMap at once, anything else is called per color
     def find_quality_popular(self, quality, colormap=None, qual_weight=0.5, pop_weight=0.5):
         if colormap == None:
             colormap = self.conversion
+        if isinstance(colormap, HSVColorMap) and isinstance(quality, Quality):
+            items, pop_scores, removed = self.score_table(colormap)
+            best = ColorFinder.best_index(quality.score_array(colormap), pop_scores, removed, qual_weight, pop_weight)
+            if best == None:
+                return None
+            return items[best]
         best_so_far = (0, None)
         for color in colormap.data:
             qual_score = quality(color)
@@ -203,49 +713,264 @@ class ColorFinder:
         if colormap == None:
             colormap = self.computation
         returnable = []
-        for i in range(count):
-            returnable.append(tuple(colormap.data[i][1]))
+        for entry in colormap.top(count):
+            returnable.append(tuple(entry[1]))
         return returnable
 
-    def strategy_enhanced_complements(self, complement_scheme="TRIAD", colormap=None):
+    # metric="hue" matches colors to the scheme by hue alone, metric="lab" by their CIELAB distance
+    # to the scheme's colors, and picks the last color by its contrast with the most colorful one
+    def strategy_enhanced_complements(self, complement_scheme="TRIAD", colormap=None, metric="hue"):
+        return self.strategy_multi_complements([complement_scheme], colormap=colormap, metric=metric)[complement_scheme]
+
+    # Runs strategy_enhanced_complements for several schemes at once, returns a dict of scheme -> colors
+    # The colorful anchor, the popularity scores and the closeness of every color to every target hue
+    # are worked out once and shared, and each scheme keeps its own set of used colors instead of a copy
+    def strategy_multi_complements(self, schemes=Palette.SCHEMES, colormap=None, metric="hue"):
         if colormap == None:
             colormap = self.conversion
-        copied = colormap.pm_copy()
+        if metric not in ("hue", "lab"):
+            raise ValueError("Unknown color metric: %s" % metric)
+        items, pop_scores, removed = self.score_table(colormap)
         cp_color = self.find_quality_popular(ColorQualities.colorful(), qual_weight=0.1, pop_weight=0.9)
 
         pal = Palette()
-        idealscheme = pal.produce_colors(cp_color, complement_scheme)
-        colorscheme = []
-        
-        for color in idealscheme:
-            match = self.find_quality_popular(ColorQualities.close(color[0]), colormap=copied, qual_weight=0.2, pop_weight=0.8)
-            copied.remove(match)
-            colorscheme.append(ColorUtil.convert_to_rgb(match))
-                
-        if cp_color[2] > 0.7:
-            colorscheme.append(ColorUtil.convert_to_rgb(self.find_quality_popular(ColorQualities.dark(), colormap=copied)))
+        idealschemes = {}
+        for scheme in schemes:
+            idealschemes[scheme] = pal.produce_colors(cp_color, scheme)
+        closeness = {}
+        for idealscheme in idealschemes.values():
+            for color in idealscheme:
+                if tuple(color) in closeness:
+                    continue
+                if metric == "lab":
+                    closeness[tuple(color)] = ColorQualities.close_lab(color).scores(colormap)
+                else:
+                    closeness[tuple(color)] = ColorQualities.close(color[0]).scores(colormap)
+        if metric == "lab":
+            last_quality = ColorQualities.contrast(cp_color).scores(colormap)
+        elif cp_color[2] > 0.7:
+            last_quality = ColorQualities.dark().scores(colormap)
+        else:
+            last_quality = ColorQualities.bright().scores(colormap)
+
+        results = {}
+        for scheme in schemes:
+            used = set(removed)
+            colorscheme = []
+            for color in idealschemes[scheme]:
+                match = ColorFinder.best_index(closeness[tuple(color)], pop_scores, used, qual_weight=0.2, pop_weight=0.8)
+                if match == None:
+                    # images with very few colors run out, so start reusing them
+                    match = ColorFinder.best_index(closeness[tuple(color)], pop_scores, removed, qual_weight=0.2, pop_weight=0.8)
+                used.add(match)
+                colorscheme.append(ColorUtil.convert_to_rgb(items[match]))
+            last = ColorFinder.best_index(last_quality, pop_scores, used)
+            if last == None:
+                last = ColorFinder.best_index(last_quality, pop_scores, removed)
+            colorscheme.append(ColorUtil.convert_to_rgb(items[last]))
+            results[scheme] = colorscheme
+        return results
+
+    # Returns the colors of a colormap, their popularity scores and the indexes of removed colors,
+    # in the same order as the scores from Quality.scores
+    def score_table(self, colormap):
+        if isinstance(colormap, HSVColorMap):
+            removed = set(numpy.flatnonzero(~colormap.active))
+            return colormap.items, colormap.counts / float(self.pixel_count), removed
+        entries = colormap.data
+        pop_scores = [float(color[0]) / float(self.pixel_count) for color in entries]
+        return [entry[1] for entry in entries], pop_scores, set()
+
+    # Same scoring as find_quality_popular over precomputed scores, skipping the indexes in used
+    # Scores can be lists or numpy arrays, returns the index of the best entry
+    @staticmethod
+    def best_index(qual_scores, pop_scores, used, qual_weight=0.5, pop_weight=0.5):
+        if numpy is not None and isinstance(qual_scores, numpy.ndarray):
+            total_scores = (qual_scores * qual_weight) + (pop_scores * pop_weight)
+            if used:
+                total_scores[list(used)] = 0
+            if len(total_scores) == 0:
+                return None
+            best = int(numpy.argmax(total_scores))
+            if total_scores[best] > 0:
+                return best
+            return None
+        best_so_far = (0, None)
+        for i in range(len(qual_scores)):
+            if i in used:
+                continue
+            total_score = (qual_scores[i] * qual_weight) + (pop_scores[i] * pop_weight)
+            if total_score > best_so_far[0]:
+                best_so_far = (total_score, i)
+        return best_so_far[1]
+
+# ColorFinder for a sequence of frames, like a burst of photos or the frames of a clip
+# Each frame fed in is added to a running histogram, so asking for a palette never rescans earlier frames
+# With decay set, the histogram is scaled by decay before every new frame, so older frames fade out
+# The histogram has at most one entry per bucket, so memory doesn't grow with the number of frames
+# Before any frame is fed, the palette of every scheme is empty
+# Needs numpy
+class StreamingColorFinder(ColorFinder):
+
+    def __init__(self, sample_budget=ColorFinder.SAMPLE_BUDGET, decay=None, exact_hsv=True, bits=PopMap.BITS, refine_bits=None):
+        if numpy is None:
+            raise ValueError("StreamingColorFinder needs numpy")
+        self.sample_budget = sample_budget
+        self.decay = decay
+        self.exact_hsv = exact_hsv
+        self.engine = "grid"
+        self.bits = bits
+        self.refine_bits = refine_bits
+        self.histogram = ArrayPopMap(bits, refine_bits)
+        self.frames = 0
+        # decayed number of samples in the histogram
+        self.sample_count = 0.0
+        self.pixel_count = 0.0
+        self.computation = PriorityMap()
+        self.conversion = ColorUtil.map_to_hsv(self.computation)
+        self.stale = False
+
+    # Adds a PIL Image to the histogram
+    def feed(self, frame):
+        frame = ColorFinder.reduce_image(frame, self.sample_budget)
+        self.stride = ColorFinder.find_stride(frame.size, self.sample_budget)
+        if self.decay != None and self.frames > 0:
+            self.histogram.decay(self.decay)
+            self.sample_count *= self.decay
+        pixels = self.sample_pixels(frame)
+        self.histogram.add_pixels(pixels)
+        self.sample_count += len(pixels)
+        self.frames += 1
+        self.stale = True
+
+    # Brings computation and conversion up to date with the frames fed so far
+    def refresh(self):
+        if self.stale:
+            self.pixel_count = self.sample_count * ColorFinder.FULL_STRIDE * ColorFinder.FULL_STRIDE
+            self.computation = self.histogram.compute()
+            self.conversion = ColorUtil.map_to_hsv(self.computation, exact=self.exact_hsv)
+            self.stale = False
+
+    # Palette for the frames so far, like strategy_enhanced_complements
+    def palette(self, complement_scheme="TRIAD", metric="hue"):
+        return self.strategy_enhanced_complements(complement_scheme, metric=metric)
+
+    def strategy_multi_complements(self, schemes=Palette.SCHEMES, colormap=None, metric="hue"):
+        if colormap == None and self.frames == 0 and metric in ("hue", "lab"):
+            return dict((scheme, []) for scheme in schemes)
+        self.refresh()
+        return ColorFinder.strategy_multi_complements(self, schemes, colormap=colormap, metric=metric)
+
+    def strategy_top_colors(self, count, colormap=None):
+        self.refresh()
+        return ColorFinder.strategy_top_colors(self, count, colormap=colormap)
+
+    def dump_histogram(self):
+        self.refresh()
+        return ColorFinder.dump_histogram(self)
+
+
+# ColorFinder for the histogram from ColorFinder.dump_histogram, without decoding the image again
+class StoredColorFinder(ColorFinder):
+
+    # Raises ValueError for anything that isn't a whole histogram from dump_histogram
+    def __init__(self, data, exact_hsv=True):
+        size = ColorFinder.HISTOGRAM_HEADER.size
+        if data == None or len(data) < size:
+            raise ValueError("Truncated histogram header")
+        magic, version, bits, refine_bits, engine, flags, sample_count, length = \
+                ColorFinder.HISTOGRAM_HEADER.unpack(data[:size])
+        if magic != ColorFinder.HISTOGRAM_MAGIC or version != ColorFinder.HISTOGRAM_VERSION:
+            raise ValueError("Not a version %d histogram" % ColorFinder.HISTOGRAM_VERSION)
+        if not 1 <= bits <= 8 or not (1 <= refine_bits <= 8 or refine_bits == 255):
+            raise ValueError("Bad histogram bits: %d, %d" % (bits, refine_bits))
+        if engine >= len(ColorFinder.ENGINES):
+            raise ValueError("Unknown histogram engine: %d" % engine)
+        if flags & ~ColorFinder.FLOAT_COUNTS:
+            raise ValueError("Unknown histogram flags: %d" % flags)
+        count_array = array.array("d" if flags & ColorFinder.FLOAT_COUNTS else "I")
+        count_size = count_array.itemsize * length
+        try:
+            body = zlib.decompress(data[size:])
+        except zlib.error, e:
+            raise ValueError("Corrupt histogram: %s" % e)
+        if len(body) != count_size + 3 * length:
+            raise ValueError("Histogram body doesn't match its header")
+        count_array.fromstring(body[:count_size])
+        if sys.byteorder != "little":
+            count_array.byteswap()
+        averages = array.array("B")
+        averages.fromstring(body[count_size:])
+
+        self.engine = ColorFinder.ENGINES[engine]
+        self.bits = bits
+        self.refine_bits = None if refine_bits == 255 else refine_bits
+        self.stride = None
+        if flags & ColorFinder.FLOAT_COUNTS:
+            self.sample_count = sample_count
         else:
-            colorscheme.append(ColorUtil.convert_to_rgb(self.find_quality_popular(ColorQualities.bright(), colormap=copied)))
-        return colorscheme
+            self.sample_count = int(sample_count)
+        self.pixel_count = self.sample_count * ColorFinder.FULL_STRIDE * ColorFinder.FULL_STRIDE
+        averages = averages.tolist()
+        self.computation = PriorityMap([(count_array[i], averages[3 * i:3 * i + 3]) for i in range(length)])
+        self.conversion = ColorUtil.map_to_hsv(self.computation, exact=exact_hsv)
 
-# returns lambdas to be used with ColorFinder.find_quality_popular
+
+# A quality to be used with ColorFinder.find_quality_popular
+# score takes one (count, color) entry, score_array takes an HSVColorMap and scores every entry at once
+class Quality:
+    def __init__(self, score, score_array):
+        self.score = score
+        self.score_array = score_array
+    def __call__(self, color):
+        return self.score(color)
+    # Scores for every entry in a colormap, as an array for an HSVColorMap and a list otherwise
+    def scores(self, colormap):
+        if isinstance(colormap, HSVColorMap):
+            return self.score_array(colormap)
+        return [self.score(color) for color in colormap.data]
+
+# returns Qualities to be used with ColorFinder.find_quality_popular
 class ColorQualities:
+    DELTA_E_RANGE = 100.0
 
     @staticmethod
     def colorful():
-        return lambda x: x[1][1]
+        return Quality(lambda x: x[1][1], lambda colormap: colormap.s)
 
     @staticmethod
     def bright():
-        return lambda x: x[1][2]
+        return Quality(lambda x: x[1][2], lambda colormap: colormap.v)
 
     @staticmethod
     def dark():
-        return lambda x: 1 - x[1][2]
+        return Quality(lambda x: 1 - x[1][2], lambda colormap: 1 - colormap.v)
 
     @staticmethod
     def close(target):
-        return lambda x: 1- ColorUtil.find_hue_difference(target, x[1][0])
+        def close_array(colormap):
+            diff = numpy.abs(colormap.h - target)
+            return 1 - numpy.minimum(diff, 1 - diff)
+        return Quality(lambda x: 1- ColorUtil.find_hue_difference(target, x[1][0]), close_array)
+
+    # Perceptual version of close, for a whole HSV target color instead of just its hue
+    # 1 for the same color in CIELAB, down to 0 for colors DELTA_E_RANGE or more apart
+    @staticmethod
+    def close_lab(target):
+        target_lab = ColorUtil.convert_to_lab(ColorUtil.convert_to_rgb(target))
+        def close_score(x):
+            distance = ColorUtil.delta_e(ColorUtil.convert_to_lab(ColorUtil.convert_to_rgb(x[1])), target_lab)
+            return 1 - min(distance / ColorQualities.DELTA_E_RANGE, 1)
+        def close_array(colormap):
+            distances = ColorUtil.delta_e_array(colormap.lab(), target_lab)
+            return 1 - numpy.minimum(distances / ColorQualities.DELTA_E_RANGE, 1)
+        return Quality(close_score, close_array)
+
+    # Opposite of close_lab, 1 for colors DELTA_E_RANGE or more away from the HSV target color
+    @staticmethod
+    def contrast(target):
+        close = ColorQualities.close_lab(target)
+        return Quality(lambda x: 1 - close.score(x), lambda colormap: 1 - close.score_array(colormap))
 
 if __name__ == "__main__":
     # load an image
@@ -259,7 +984,7 @@ if __name__ == "__main__":
     # display palette of top 4 colors
     top = ColorUtil.generate_color_panes(tuple(cf.strategy_top_colors(4)))
     top.show()
-    # use the Enhanced Triad heuristic to display a palette
-    ColorUtil.generate_color_panes(tuple(cf.strategy_enhanced_complements(complement_scheme="TRIAD"))).show()
-    ColorUtil.generate_color_panes(tuple(cf.strategy_enhanced_complements(complement_scheme="TETRAD"))).show()
-    ColorUtil.generate_color_panes(tuple(cf.strategy_enhanced_complements(complement_scheme="ACC_ANALOG"))).show()
+    # use the Enhanced Triad, Tetrad and Accented Analogous heuristics to display palettes
+    palettes = cf.strategy_multi_complements(["TRIAD", "TETRAD", "ACC_ANALOG"])
+    for scheme in ["TRIAD", "TETRAD", "ACC_ANALOG"]:
+        ColorUtil.generate_color_panes(tuple(palettes[scheme])).show()
@@ -0,0 +1,219 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+# Queues of small JSON jobs that are handled in the background, in order for each user
+# Every queue has the same methods:
+#   enqueue(user, job)   job is a dict that can be turned in to JSON
+#   work(handle, user)   handles waiting jobs with handle(user, job), only those of user if it isn't None,
+#                        returns how many were handled
+# A job that raises is tried again later, and the jobs of that user behind it wait for it
+# A job that raises PermanentError, or fails MAX_ATTEMPTS times, is logged and dropped instead,
+# so one bad job can't hold up the rest of its user's jobs for good
+
+# How many jobs of a user are taken at once
+BATCH_SIZE = 5
+MAX_ATTEMPTS = 5
+
+
+# Raised by a job handler for a job that would fail again however many times it was tried
+class PermanentError(Exception):
+    pass
+
+# Whether a job that raised error, on its attempts'th try, should be dropped
+def drop_failed(user, error, attempts):
+    if isinstance(error, PermanentError):
+        logging.error("Dropping job for %s, it can't succeed: %s", user, error)
+        return True
+    if attempts >= MAX_ATTEMPTS:
+        logging.error("Dropping job for %s after %d attempts: %s", user, attempts, error)
+        return True
+    logging.exception("Job for %s failed, it will be tried again", user)
+    return False
+
+
+# App Engine pull queue with a task per job, tagged with its user
+# Each job also adds a task to a push queue that calls the worker URL with the user, which then runs work
+# How many workers run at once is set by max_concurrent_requests of the push queue in queue.yaml
+# Workers take the jobs of one user at a time: a memcache lock keeps two workers off the same user, and
+# is taken before leasing anything, so a worker that finds the user busy leaves their tasks alone
+# The leases and the lock are renewed before each job, so they only have to outlast a single job
+# Attempts are counted in memcache for each task, since leasing a task counts as an attempt in retry_count
+# whether or not it was handled. If memcache loses a count, the job gets up to MAX_ATTEMPTS more tries
+# taskqueue and memcache are the App Engine modules unless others are given, for tests
+class TaskQueue:
+    LEASE_SECONDS = 300
+    RETRY_SECONDS = 10
+
+    def __init__(self, pull_queue="shares", push_queue="share-workers", worker_url="/tasks/shares",
+                 taskqueue=None, memcache=None):
+        if taskqueue == None:
+            from google.appengine.api import taskqueue
+        if memcache == None:
+            from google.appengine.api import memcache
+        self.taskqueue = taskqueue
+        self.memcache = memcache
+        self.pull_queue = pull_queue
+        self.push_queue = push_queue
+        self.worker_url = worker_url
+
+    def enqueue(self, user, job):
+        task = self.taskqueue.Task(payload=json.dumps(job), method="PULL", tag=user)
+        self.taskqueue.Queue(self.pull_queue).add(task)
+        self.wake(user)
+
+    # Has a worker run work for user, after countdown seconds
+    def wake(self, user, countdown=0):
+        self.taskqueue.Queue(self.push_queue).add(
+                self.taskqueue.Task(url=self.worker_url, params={"user": user}, countdown=countdown))
+
+    def work(self, handle, user=None):
+        queue = self.taskqueue.Queue(self.pull_queue)
+        if user == None:
+            # wakes from before they named a user: find one from the oldest job, and leave it to be leased again
+            tasks = queue.lease_tasks_by_tag(self.LEASE_SECONDS, 1)
+            if not tasks:
+                return 0
+            queue.modify_task_lease(tasks[0], 0)
+            user = tasks[0].tag
+        lock = "worker:%s" % user
+        if not self.memcache.add(lock, True, time=self.LEASE_SECONDS, namespace=self.pull_queue):
+            # another worker has this user, it may have finished by the time this wakes again
+            self.wake(user, self.RETRY_SECONDS)
+            return 0
+        handled = 0
+        try:
+            tasks = queue.lease_tasks_by_tag(self.LEASE_SECONDS, BATCH_SIZE, tag=user)
+            for index, task in enumerate(tasks):
+                if index > 0:
+                    # keep this worker's claim on the jobs it hasn't got to yet
+                    for waiting in tasks[index:]:
+                        queue.modify_task_lease(waiting, self.LEASE_SECONDS)
+                    self.memcache.set(lock, True, time=self.LEASE_SECONDS, namespace=self.pull_queue)
+                attempts_key = "attempts:%s" % task.name
+                # None when memcache is unavailable, then leases are all there is to count
+                attempts = self.memcache.incr(attempts_key, namespace=self.pull_queue, initial_value=0)
+                try:
+                    handle(user, json.loads(task.payload))
+                except Exception, e:
+                    if not drop_failed(user, e, attempts or task.retry_count + 1):
+                        for waiting in tasks[index:]:
+                            queue.modify_task_lease(waiting, 0)
+                        self.wake(user, self.RETRY_SECONDS)
+                        break
+                queue.delete_tasks(task)
+                self.memcache.delete(attempts_key, namespace=self.pull_queue)
+                handled += 1
+        finally:
+            self.memcache.delete(lock, namespace=self.pull_queue)
+        if handled == BATCH_SIZE:
+            # there may be more of this user's jobs behind these
+            self.wake(user)
+        return handled
+
+
+# In-process queue, for tests and running outside App Engine
+# With workers set, a pool of that many threads handles jobs as soon as they are queued
+# Without, jobs wait until work is called
+class LocalQueue:
+    RETRY_SECONDS = 1.0
+
+    def __init__(self, handle=None, workers=None):
+        self.handle = handle
+        self.jobs = collections.OrderedDict()
+        # users that have a job being handled right now
+        self.busy = set()
+        self.condition = threading.Condition()
+        self.threads = []
+        for i in range(workers or 0):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    # Each waiting job is kept as [job, attempts so far]
+    def enqueue(self, user, job):
+        with self.condition:
+            self.jobs.setdefault(user, collections.deque()).append([json.loads(json.dumps(job)), 0])
+            self.condition.notify()
+
+    # Oldest waiting user that isn't busy, and their jobs, or None
+    # With only_user set, only that user is taken
+    # Expects the condition to be held
+    def take(self, only_user=None):
+        for user, waiting in self.jobs.items():
+            if user not in self.busy and only_user in (None, user):
+                del self.jobs[user]
+                self.busy.add(user)
+                return user, waiting
+        return None
+
+    def handle_jobs(self, handle, user, waiting):
+        handled = 0
+        try:
+            while waiting:
+                entry = waiting[0]
+                entry[1] += 1
+                try:
+                    handle(user, entry[0])
+                except Exception, e:
+                    if not drop_failed(user, e, entry[1]):
+                        break
+                waiting.popleft()
+                handled += 1
+        finally:
+            with self.condition:
+                self.busy.discard(user)
+                if waiting:
+                    # put back in front of anything queued for this user since
+                    waiting.extend(self.jobs.pop(user, []))
+                    self.jobs[user] = waiting
+                self.condition.notify_all()
+        return handled
+
+    def work(self, handle=None, user=None):
+        handle = handle or self.handle
+        handled = 0
+        while True:
+            with self.condition:
+                taken = self.take(user)
+            if taken == None:
+                return handled
+            handled += self.handle_jobs(handle, *taken)
+            if taken[1]:
+                # a failed job stays at the head of its user's queue until the next call
+                return handled
+
+    def run(self):
+        while True:
+            with self.condition:
+                taken = self.take()
+                while taken == None:
+                    self.condition.wait()
+                    taken = self.take()
+            self.handle_jobs(self.handle, *taken)
+            if taken[1]:
+                # wait a moment before trying a failing job again
+                time.sleep(self.RETRY_SECONDS)
+
+    def __len__(self):
+        with self.condition:
+            return sum(len(waiting) for waiting in self.jobs.values())
+
+
+queue = None
+queue_lock = threading.Lock()
+
+# Queue for Glass shares: a TaskQueue on App Engine, otherwise a LocalQueue with a few worker threads
+# handle is what the LocalQueue workers call, the TaskQueue worker URL passes its own
+def share_queue(handle, workers=4):
+    global queue
+    with queue_lock:
+        if queue == None:
+            try:
+                queue = TaskQueue()
+            except ImportError:
+                queue = LocalQueue(handle, workers)
+        return queue
@@ -29,10 +29,12 @@ from notify.handler import NOTIFY_ROUTES
 from oauth.handler import OAUTH_ROUTES
 from signout.handler import SIGNOUT_ROUTES
 from blobs.handler import BLOB_ROUTES
+from palettes.handler import PALETTE_ROUTES
 
 
 #ROUTES = (ATTACHMENT_PROXY_ROUTES + MAIN_ROUTES + NOTIFY_ROUTES + OAUTH_ROUTES + SIGNOUT_ROUTES)
-ROUTES = (MAIN_ROUTES + NOTIFY_ROUTES + OAUTH_ROUTES + SIGNOUT_ROUTES + BLOB_ROUTES)
+ROUTES = (MAIN_ROUTES + NOTIFY_ROUTES + OAUTH_ROUTES + SIGNOUT_ROUTES + BLOB_ROUTES +
+          PALETTE_ROUTES)
 
 
 app = webapp2.WSGIApplication(ROUTES)
@@ -34,7 +34,8 @@ from apiclient.http import BatchHttpRequest
 from oauth2client.appengine import StorageByKeyName
 
 from model import Credentials
-from model import Picture
+import gallery
+import timing
 import util
 from image_operator import ImageOperator
 
@@ -70,13 +71,12 @@ class MainHandler(webapp2.RequestHandler):
   def _render_template(self):
     # """Render the main page template."""
 
-    pictures_query = Picture.query(ancestor=Picture.picture_key(str(self.userid))).order(-Picture.date)
-    pictures = pictures_query.fetch(3) 
+    def render(pictures):
+      template_values = {'userId': self.userid, 'pictures': pictures}
+      template = jinja_environment.get_template('templates/index.html')
+      return template.render(template_values)
 
-    template_values = {'userId': self.userid, 'pictures': pictures}
-
-    template = jinja_environment.get_template('templates/index.html')
-    self.response.out.write(template.render(template_values))
+    self.response.out.write(gallery.page(str(self.userid), render))
 
   @util.auth_required
   def get(self):
@@ -91,7 +91,8 @@ class MainHandler(webapp2.RequestHandler):
     if image == None:
         self.redirect("/")
     else:
-        ImageOperator.process(user_id, image)
+        with timing.trace("upload"):
+            ImageOperator.process(user_id, image)
     self.redirect("/")
 
 
@@ -22,18 +22,46 @@ from google.appengine.ext import ndb
 
 from oauth2client.appengine import CredentialsProperty
 
+import storage
+
 
 class Picture(ndb.Model):
     """ Models an uploaded picture and a generated palette."""
     owner = ndb.StringProperty()
     picture = ndb.StringProperty(indexed=False)
     palette = ndb.StringProperty(indexed=False)
+    # Downscaled copies of picture, see ImageOperator.DERIVATIVES, and how wide each of them really is
+    thumbnail = ndb.StringProperty(indexed=False)
+    medium = ndb.StringProperty(indexed=False)
+    thumbnail_width = ndb.IntegerProperty(indexed=False)
+    medium_width = ndb.IntegerProperty(indexed=False)
+    # ColorFinder.dump_histogram of the picture, so other palettes can be made without decoding it again
+    histogram = ndb.BlobProperty()
+    # Id of the timeline card the palette was sent to Glass in, for pictures shared from Glass
+    card = ndb.StringProperty(indexed=False)
     date = ndb.DateTimeProperty(auto_now_add=True)
 
     @staticmethod
     def picture_key(username):
         return ndb.Key("Picture", username)
 
+    # Key of the Picture made from source, like the id of the timeline item it was shared in
+    @staticmethod
+    def source_key(username, source):
+        return ndb.Key("Picture", source, parent=Picture.picture_key(username))
+
+    # Picture for the value of key.urlsafe(), or None if it has been deleted
+    @staticmethod
+    def get_by_urlsafe(value):
+        return ndb.Key(urlsafe=value).get()
+
+    # picture and palette are keys in storage.get_backend()
+    def picture_data(self):
+        return storage.get_backend().read(self.picture)
+
+    def palette_data(self):
+        return storage.get_backend().read(self.palette)
+
 class Credentials(db.Model):
   """Datastore entity for storing OAuth2.0 credentials.
 
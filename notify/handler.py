@@ -1,4 +1,3 @@
-from __future__ import with_statement
 # Copyright (C) 2013 Google Inc.
 #
 # Licensed under the Apache License, Version 2.0 (the "License");
@@ -15,22 +14,100 @@ from __future__ import with_statement
 
 """Request Handler for /notify endpoint."""
 
+from __future__ import with_statement
+
 __author__ = 'alainv@google.com (Alain Vongsouvanh)'
 
 
 
-import io
-import StringIO
 import json
 import logging
 import webapp2
 
+import Image
+from apiclient.errors import HttpError
+from apiclient.http import MediaIoBaseDownload
 from apiclient.http import MediaIoBaseUpload
 from oauth2client.appengine import StorageByKeyName
 
-from model import Credentials
+from model import Credentials, Picture
+import jobs
+import storage
+import timing
 import util
-from image_operator import ImageOperator
+from image_operator import ImageOperator, UndecodableImage
+
+# Limits on the attachments of shares, which bound the memory each share being handled can take
+# Attachments are downloaded CHUNK_BYTES at a time, and given up on as soon as they are known to be over
+# MAX_ATTACHMENT_BYTES or MAX_PIXELS, or once all of it has arrived without PIL finding an image header
+# The chunks are handed on as they are, never joined, so a share holds MAX_ATTACHMENT_BYTES at most
+# before decoding starts
+MAX_ATTACHMENT_BYTES = 16 * 1024 * 1024
+MAX_PIXELS = 40 * 1000 * 1000
+CHUNK_BYTES = 1024 * 1024
+
+
+class AttachmentError(Exception):
+  """An attachment that won't be made in to a palette."""
+
+
+class AttachmentBuffer(object):
+  """Collects a download, checking it against the limits as it arrives.
+
+  The size of the image is read from the start of the download as soon as
+  its header has arrived, however long the header is, without decoding
+  anything or waiting for the rest of it.
+  """
+
+  def __init__(self, max_bytes=MAX_ATTACHMENT_BYTES, max_pixels=MAX_PIXELS):
+    self.max_bytes = max_bytes
+    self.max_pixels = max_pixels
+    self.chunks = []
+    self.size = 0
+    self.image_size = None
+
+  def write(self, data):
+    self.size += len(data)
+    if self.size > self.max_bytes:
+      raise AttachmentError('Attachment is over %d bytes' % self.max_bytes)
+    self.chunks.append(data)
+    if self.image_size == None:
+      try:
+        # Image.open only reads the header, it doesn't allocate or decode the image
+        self.image_size = Image.open(storage.ChunkReader(self.chunks)).size
+      except IOError:
+        # the header can be longer than what has arrived, like a JPEG with a big ICC profile
+        return
+      if self.image_size[0] * self.image_size[1] > self.max_pixels:
+        raise AttachmentError('Image is %dx%d, over %d pixels' % (
+            self.image_size[0], self.image_size[1], self.max_pixels))
+
+  def getvalue(self):
+    """Returns the list of chunks that arrived, once all of them have."""
+    if self.image_size == None:
+      raise AttachmentError('Attachment is not an image PIL can read')
+    return self.chunks
+
+
+def download_attachment(mirror_service, item_id, attachment):
+  """Downloads an attachment as a list of chunks, raises AttachmentError if it is too big or not an image."""
+  content_type = attachment.get('contentType', '')
+  if not content_type.startswith('image/'):
+    raise AttachmentError('Attachment is %s, not an image' % content_type)
+  request = mirror_service.timeline().attachments().get_media(
+      itemId=item_id, attachmentId=attachment['id'])
+  buf = AttachmentBuffer(MAX_ATTACHMENT_BYTES, MAX_PIXELS)
+  downloader = MediaIoBaseDownload(buf, request, chunksize=CHUNK_BYTES)
+  done = False
+  while not done:
+    status, done = downloader.next_chunk()
+    if status.total_size == None:
+      # the whole attachment came back at once
+      break
+    if status.total_size > MAX_ATTACHMENT_BYTES:
+      raise AttachmentError('Attachment is %d bytes, over %d' % (
+          status.total_size, MAX_ATTACHMENT_BYTES))
+  return buf.getvalue()
 
 
 class NotifyHandler(webapp2.RequestHandler):
@@ -42,13 +119,15 @@ class NotifyHandler(webapp2.RequestHandler):
     data = json.loads(self.request.body)
     userid = data['userToken']
     # TODO: Check that the userToken is a valid userToken.
-    self.mirror_service = util.create_service(
-        'mirror', 'v1',
-        StorageByKeyName(Credentials, userid, 'credentials').get())
     if data.get('collection') == 'locations':
+      # shares build their own service in the background, so only locations need one here
+      self.mirror_service = util.create_service(
+          'mirror', 'v1',
+          StorageByKeyName(Credentials, userid, 'credentials').get())
       self._handle_locations_notification(data)
     elif data.get('collection') == 'timeline':
-      self._handle_timeline_notification(data)
+      with timing.trace('notify'):
+        self._handle_timeline_notification(data)
 
   def _handle_locations_notification(self, data):
     """Handle locations notification."""
@@ -64,38 +143,16 @@ class NotifyHandler(webapp2.RequestHandler):
     self.mirror_service.timeline().insert(body=body).execute()
 
   def _handle_timeline_notification(self, data):
-    """Handle timeline notification."""
+    """Handle timeline notification.
+
+    Shares are handled in the background by handle_share, so Mirror gets its
+    answer straight away however big the image is.
+    """
     for user_action in data.get('userActions', []):
       if user_action.get('type') == 'SHARE':
-        # Fetch the timeline item.
-        item = self.mirror_service.timeline().get(id=data['itemId']).execute()
-        attachments = item.get('attachments', [])
-        media = None
-        if attachments:
-          # Get the first attachment on that timeline item and do stuff with it.
-          attachment = self.mirror_service.timeline().attachments().get(
-              itemId=data['itemId'],
-              attachmentId=attachments[0]['id']).execute()
-          resp, content = self.mirror_service._http.request(
-              attachment['contentUrl'])
-          if resp.status == 200:
-            # Process the image, put the original & generated palette in the blobstore
-            # then link them together in the datastore
-            palette = ImageOperator.process(str(data['userToken']), content)
-            # Send the generated palette back to the glass
-            media = MediaIoBaseUpload(
-                palette, mimetype='image/jpeg',
-                resumable=True)
-            body = {
-                'notification': {'level': 'DEFAULT'},
-                'menuItems': [{'action': 'SHARE'}, {'action': 'DELETE'}]
-            }
-            self.mirror_service.timeline().insert(
-                body=body, media_body=media).execute()
-            # Now remove original item shared from the glass timeline
-            self.mirror_service.timeline().delete(id=data['itemId']).execute()
-          else:
-            logging.info('Unable to retrieve attachment: %s', resp.status)
+        with timing.span('enqueue'):
+          jobs.share_queue(handle_share).enqueue(
+              str(data['userToken']), {'itemId': data['itemId']})
         # Only handle the first successful action.
         break
       else:
@@ -103,6 +160,84 @@ class NotifyHandler(webapp2.RequestHandler):
             "I don't know what to do with this notification: %s", user_action)
 
 
+class ShareWorkerHandler(webapp2.RequestHandler):
+  """Request Handler for the task queue worker that handles shares."""
+
+  def post(self):
+    """Handles the shares waiting in the queue."""
+    handled = jobs.share_queue(handle_share).work(handle_share, self.request.get('user') or None)
+    logging.info('Handled %d shares', handled)
+
+
+def handle_share(userid, job):
+  """Makes a palette for a shared timeline item and sends it back to Glass."""
+  mirror_service = util.create_service(
+      'mirror', 'v1',
+      StorageByKeyName(Credentials, userid, 'credentials').get())
+  with timing.trace('share'):
+    try:
+      _handle_share(mirror_service, userid, job['itemId'])
+    except HttpError, e:
+      # the item was deleted, or the user took away access, trying again won't help
+      # timeouts and rate limits are worth trying again
+      if 400 <= e.resp.status < 500 and e.resp.status not in (408, 429):
+        raise jobs.PermanentError(repr(e))
+      raise
+
+
+def _handle_share(mirror_service, userid, item_id):
+  # Fetch the timeline item.
+  with timing.span('timeline_get'):
+    item = mirror_service.timeline().get(id=item_id).execute()
+  attachments = item.get('attachments', [])
+  media = None
+  if attachments:
+    # Get the first attachment on that timeline item and do stuff with it.
+    with timing.span('attachment_download') as span:
+      attachment = mirror_service.timeline().attachments().get(
+          itemId=item_id,
+          attachmentId=attachments[0]['id']).execute()
+      try:
+        content = download_attachment(mirror_service, item_id, attachment)
+      except AttachmentError, e:
+        content = None
+        logging.info('Unable to use attachment: %s', e)
+      span.nbytes = storage.data_length(content or [])
+    if content != None:
+      # Process the image, put the original & generated palette in the blobstore
+      # then link them together in the datastore
+      # A share that is tried again after this reuses the Picture stored for the item
+      try:
+        palette = ImageOperator.process(userid, content, source=item_id)
+      except UndecodableImage, e:
+        # PIL couldn't decode the attachment, like a JPEG that is cut short
+        raise jobs.PermanentError('Unreadable image: %s' % e)
+      picture = Picture.source_key(userid, item_id).get()
+      if picture.card == None:
+        # Send the generated palette back to the glass
+        media = MediaIoBaseUpload(
+            palette, mimetype='image/jpeg',
+            resumable=True)
+        body = {
+            'notification': {'level': 'DEFAULT'},
+            'menuItems': [{'action': 'SHARE'}, {'action': 'DELETE'}]
+        }
+        with timing.span('timeline_insert'):
+          card = mirror_service.timeline().insert(
+              body=body, media_body=media).execute()
+        # recorded straight away, so a retry doesn't send the card again
+        picture.card = card['id']
+        picture.put()
+      # Now remove original item shared from the glass timeline
+      with timing.span('timeline_delete'):
+        try:
+          mirror_service.timeline().delete(id=item_id).execute()
+        except HttpError, e:
+          # already deleted by an earlier try
+          if e.resp.status != 404:
+            raise
+
 NOTIFY_ROUTES = [
-    ('/notify', NotifyHandler)
+    ('/notify', NotifyHandler),
+    ('/tasks/shares', ShareWorkerHandler)
 ]
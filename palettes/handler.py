@@ -0,0 +1,98 @@
+import hashlib
+import re
+import webapp2
+from google.appengine.ext import ndb
+
+import cache
+import imaging
+import storage
+import util
+from image_operator import ImageOperator, MissingOriginal
+from model import Picture
+
+# Renders the palette of a stored Picture in any scheme, size and format:
+#   /palette/<urlsafe picture key>?scheme=TETRAD&size=320x180&format=png
+# Only the owner of a Picture gets its palettes, anyone else gets a 404 as if it didn't exist.
+# A stored picture never changes, so the same URL always renders the same bytes. The ETag is worked
+# out from the URL alone, so once the session cookie shows the Picture is the user's own, a matching
+# If-None-Match gets a 304 without loading anything. Responses can be cached forever, but only by
+# the browser, since they are only for the user who owns the Picture
+FORMATS = {
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+    'gif': ('GIF', 'image/gif'),
+}
+MAX_SIZE = 2048
+CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Rendered outputs by ETag, in this instance
+RENDERED_CACHE_BYTES = 4 * 1024 * 1024
+rendered_cache = cache.LRUCache(RENDERED_CACHE_BYTES)
+
+def parse_size(value):
+  match = re.match(r'^(\d+)x(\d+)$', value)
+  if match == None:
+    return None
+  size = (int(match.group(1)), int(match.group(2)))
+  if not (0 < size[0] <= MAX_SIZE and 0 < size[1] <= MAX_SIZE):
+    return None
+  return size
+
+# Key of the Picture named by resource, or None if it doesn't name one of userid's Pictures
+def owned_picture_key(resource, userid):
+  if not userid:
+    return None
+  try:
+    key = ndb.Key(urlsafe=resource)
+  except Exception:
+    return None
+  if key.kind() != 'Picture' or key.parent() != Picture.picture_key(userid):
+    return None
+  return key
+
+def palette_etag(resource, scheme, size, image_format):
+  digest = hashlib.sha1('%s:%s:%dx%d:%s:v%d' % (
+      resource, scheme, size[0], size[1], image_format, ImageOperator.RENDER_VERSION)).hexdigest()
+  return '"%s"' % digest
+
+class PaletteHandler(webapp2.RequestHandler):
+  def get(self, resource):
+    scheme = self.request.get('scheme', 'TRIAD').upper()
+    size = parse_size(self.request.get('size', '640x360'))
+    image_format = self.request.get('format', 'jpeg').lower()
+    if scheme not in imaging.Palette.SCHEMES or size == None or image_format not in FORMATS:
+      self.abort(400)
+    pil_format, content_type = FORMATS[image_format]
+
+    key = owned_picture_key(resource, util.load_session_userid(self))
+    if key == None:
+      self.abort(404)
+
+    etag = palette_etag(resource, scheme, size, image_format)
+    self.response.headers['ETag'] = etag
+    self.response.headers['Cache-Control'] = CACHE_CONTROL
+    if_none_match = storage.none_match_tags(self.request.headers.get('If-None-Match'))
+    if etag in if_none_match:
+      self.response.status = 304
+      return
+
+    rendered = rendered_cache.get(etag)
+    if rendered == None or '*' in if_none_match:
+      picture = key.get()
+      if picture == None:
+        self.abort(404)
+      # "*" matches any version of the palette, but only if the Picture exists
+      if '*' in if_none_match:
+        self.response.status = 304
+        return
+      try:
+        rendered = ImageOperator.repalette(picture, scheme, size, pil_format)[0]
+      except MissingOriginal:
+        self.abort(404)
+      rendered_cache.put(etag, rendered)
+    self.response.headers['Content-Type'] = content_type
+    self.response.out.write(rendered)
+
+PALETTE_ROUTES = [
+    ('/palette/([^/]+)', PaletteHandler)
+]
@@ -0,0 +1,166 @@
+import collections
+import logging
+import threading
+
+import Image
+
+# Width and height of the grayscale thumbnail the difference hash is made from
+HASH_SIZE = 8
+
+
+# 64 bit difference hash of a PIL Image, which survives re-encoding, resizing and metadata changes
+# Each bit says whether a pixel of a 9x8 grayscale thumbnail is brighter than the one to its right
+# JPEGs are decoded at 1/8 scale for it, which changes the size of the image passed in
+def dhash(image):
+    if image.format == "JPEG":
+        image.draft("L", (HASH_SIZE + 1, HASH_SIZE))
+    small = image.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.ANTIALIAS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(HASH_SIZE):
+        for column in range(HASH_SIZE):
+            left = pixels[row * (HASH_SIZE + 1) + column]
+            right = pixels[row * (HASH_SIZE + 1) + column + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+def hamming(first, second):
+    return bin(first ^ second).count("1")
+
+
+# Burkhard-Keller tree of hashes, for finding the hashes within a Hamming distance of another one
+# without comparing against all of them
+# Each node is [hash, value, {distance: child}]
+class BKTree:
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hashed, value):
+        self.size += 1
+        if self.root == None:
+            self.root = [hashed, value, {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(hashed, node[0])
+            if distance == 0:
+                node[1] = value
+                self.size -= 1
+                return
+            child = node[2].get(distance)
+            if child == None:
+                node[2][distance] = [hashed, value, {}]
+                return
+            node = child
+
+    # (distance, hash, value) of every entry within threshold of hashed, closest first
+    def search(self, hashed, threshold):
+        found = []
+        if self.root == None:
+            return found
+        pending = [self.root]
+        while pending:
+            node = pending.pop()
+            distance = hamming(hashed, node[0])
+            if distance <= threshold:
+                found.append((distance, node[0], node[1]))
+            for child_distance, child in node[2].iteritems():
+                if distance - threshold <= child_distance <= distance + threshold:
+                    pending.append(child)
+        found.sort(key=lambda entry: entry[0])
+        return found
+
+
+# Per-user index of image hashes, pointing at whatever identifies their earlier results
+# Each user's entries are kept in the shared cache as a ring of max_entries slots, numbered by an
+# atomic counter, so uploads at the same time on different instances don't overwrite each other's entries
+# Trees are built in this instance from the slots, and brought up to date with any slots filled since
+# before each lookup. Trees of up to max_users users are kept, the least recently used go first
+#
+# add takes a number before it writes the slot, so a lookup in between can see the number and not the entry.
+# Slots keep their number, and a tree is only marked as up to date to just before the first slot that is
+# missing, so that slot is read again on the next lookup. Slots more than LATE_SLOTS behind the counter
+# are given up on, since the upload that took the number has most likely failed
+# Trees are synced and searched while holding the lock, shared cache reads included. Lookups only happen
+# on uploads, so they rarely wait for each other, and a tree is never changed while another thread reads it
+class NearDuplicateIndex:
+    THRESHOLD = 6
+    MAX_ENTRIES = 500
+    MAX_USERS = 1000
+    LATE_SLOTS = 16
+
+    # Slots hold (number, hash, value). The namespace changed when the number was added to them
+    def __init__(self, shared, namespace="near-duplicates-2", threshold=THRESHOLD, max_entries=MAX_ENTRIES,
+                 max_users=MAX_USERS):
+        self.shared = shared
+        self.namespace = namespace
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_users = max_users
+        # owner -> [tree, number of the last slot it is up to date with]
+        self.trees = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def slot_key(self, owner, number):
+        return "%s:%d" % (owner, number % self.max_entries)
+
+    # Brings the tree of owner's entries up to date with the slots, including any added by other instances
+    # Must be called while holding the lock
+    def tree(self, owner):
+        count = self.shared.get("count:" + owner, namespace=self.namespace) or 0
+        cached = self.trees.pop(owner, None)
+        if cached == None or len(cached[0]) + count - cached[1] > self.max_entries:
+            # slots only hold the last max_entries entries, older ones are dropped by starting again
+            cached = [BKTree(), max(0, count - self.max_entries)]
+        if cached[1] < count:
+            numbers = range(cached[1] + 1, count + 1)
+            found = self.shared.get_multi([self.slot_key(owner, number) for number in numbers],
+                                          namespace=self.namespace)
+            waiting = False
+            for number in numbers:
+                entry = found.get(self.slot_key(owner, number))
+                if entry != None and entry[0] == number:
+                    cached[0].add(entry[1], entry[2])
+                elif number > count - self.LATE_SLOTS:
+                    # not written yet, or still holding the entry from the last time round the ring
+                    waiting = True
+                if not waiting:
+                    cached[1] = number
+        self.trees[owner] = cached
+        while len(self.trees) > self.max_users:
+            self.trees.popitem(last=False)
+        return cached[0]
+
+    # Value stored for the closest earlier image of owner's within the threshold, or None
+    def find(self, owner, hashed):
+        with self.lock:
+            found = self.tree(owner).search(hashed, self.threshold)
+            self.lookups += 1
+            if found:
+                self.hits += 1
+        if found:
+            logging.info("Near duplicate at distance %d, hit rate %.2f over %d lookups",
+                         found[0][0], self.hit_rate(), self.lookups)
+            return found[0][2]
+        return None
+
+    def add(self, owner, hashed, value):
+        number = self.shared.incr("count:" + owner, namespace=self.namespace, initial_value=0)
+        if number == None:
+            # the shared cache is unavailable
+            return
+        self.shared.set(self.slot_key(owner, number), (number, hashed, value), namespace=self.namespace)
+
+    def hit_rate(self):
+        if self.lookups == 0:
+            return 0.0
+        return float(self.hits) / self.lookups
+
+    def stats(self):
+        return {"lookups": self.lookups, "hits": self.hits, "hit_rate": self.hit_rate(), "users": len(self.trees)}
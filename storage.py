@@ -0,0 +1,304 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+import uuid
+
+import cache
+
+# Where uploads and palettes are kept. Every backend has the same methods:
+#   write(data, content_type) -> key    stores a str or a list of str chunks, returns the key to find it by later
+#   read(key) -> str or None
+#   exists(key) -> bool
+#   serve(handler, key) -> bool         writes the blob as the response of a webapp2 handler,
+#                                       honouring its Range header, False if there is no such blob
+# Keys are plain strs, so they can be stored in Picture and put in /serve/ URLs
+
+# Data to write can be a list of str chunks, like a download that arrived in pieces,
+# so it is never joined in to one str and held twice
+def chunks(data):
+    if isinstance(data, list):
+        return data
+    return [data]
+
+def data_length(data):
+    return sum(len(chunk) for chunk in chunks(data))
+
+def data_digest(data):
+    digest = hashlib.sha256()
+    for chunk in chunks(data):
+        digest.update(chunk)
+    return digest.hexdigest()
+
+# Read-only file over a list of str chunks, with the read, seek and tell PIL needs to decode from it
+class ChunkReader:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.size = data_length(chunks)
+        self.position = 0
+        # chunk the position is in, and where that chunk starts
+        self.index = 0
+        self.start = 0
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.position
+        elif whence == 2:
+            offset += self.size
+        self.position = max(0, offset)
+        if self.position < self.start:
+            self.index = 0
+            self.start = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size
+        parts = []
+        while size > 0 and self.index < len(self.chunks):
+            chunk = self.chunks[self.index]
+            if self.position >= self.start + len(chunk):
+                self.start += len(chunk)
+                self.index += 1
+                continue
+            offset = self.position - self.start
+            part = chunk[offset:offset + size]
+            parts.append(part)
+            self.position += len(part)
+            size -= len(part)
+        return "".join(parts)
+
+    def readline(self):
+        parts = []
+        while True:
+            part = self.read(1)
+            parts.append(part)
+            if part in ("", "\n"):
+                return "".join(parts)
+
+    def close(self):
+        pass
+
+
+class AppEngineStorage:
+    # BlobInfos looked up by serve, which never change once a blob is written
+    BLOB_INFO_ENTRIES = 1024
+
+    def __init__(self):
+        self.blob_infos = cache.LRUCache(AppEngineStorage.BLOB_INFO_ENTRIES, sizeof=lambda blob_info: 1)
+
+    def write(self, data, content_type):
+        from google.appengine.api import files
+        file_name = files.blobstore.create(mime_type=content_type)
+        with files.open(file_name, 'a') as f:
+            for chunk in chunks(data):
+                f.write(chunk)
+        files.finalize(file_name)
+        return str(files.blobstore.get_blob_key(file_name))
+
+    def read(self, key):
+        from google.appengine.ext import blobstore
+        if blobstore.BlobInfo.get(key) == None:
+            return None
+        return blobstore.BlobReader(key).read()
+
+    # BlobInfo of key, or None if there is no such blob
+    def blob_info(self, key):
+        from google.appengine.ext import blobstore
+        blob_info = self.blob_infos.get(key)
+        if blob_info == None:
+            blob_info = blobstore.BlobInfo.get(key)
+            if blob_info != None:
+                self.blob_infos.put(key, blob_info)
+        return blob_info
+
+    def exists(self, key):
+        return self.blob_info(key) != None
+
+    # Needs a BlobstoreDownloadHandler, so App Engine serves the blob without it passing through the app
+    def serve(self, handler, key):
+        blob_info = self.blob_info(key)
+        if blob_info == None:
+            handler.error(404)
+            return False
+        handler.send_blob(blob_info, use_range=True)
+        return True
+
+
+# Keys for the backends that make up their own, a random name with an extension for the content type
+KEY_PATTERN = re.compile(r"^[0-9a-f]{32}(\.[0-9a-z]+)?$")
+
+# mimetypes picks odd extensions like .jpe for some types
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/gif": ".gif"}
+
+def new_key(content_type):
+    return uuid.uuid4().hex + (EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type) or "")
+
+def key_content_type(key):
+    return mimetypes.guess_type(key)[0] or "application/octet-stream"
+
+# (start, end) of a single "bytes=" range in a Range header, end inclusive, for data of size bytes
+# None when there is no range or more than one, False when the range is outside the data
+def parse_range(header, size):
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (header or "").strip())
+    if match == None or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        start = max(0, size - int(match.group(2)))
+        end = size - 1
+    else:
+        start = int(match.group(1))
+        end = min(size - 1, int(match.group(2) or size - 1))
+    if start > end:
+        return False
+    return (start, end)
+
+# Entity tags listed in an If-None-Match header, with weak ones (W/"...") compared as strong ones,
+# which is how If-None-Match compares them
+def none_match_tags(header):
+    tags = []
+    for tag in (header or "").split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag:
+            tags.append(tag)
+    return tags
+
+# Whether a request with these headers for the blob at key gets a 304, given that blobs never change
+# Its own ETag means the client already has the blob. "*", or If-Modified-Since without If-None-Match,
+# only say the client has whatever is there, so they get a 304 only when the blob exists
+def not_modified(backend, key, headers):
+    tags = none_match_tags(headers.get('If-None-Match'))
+    if '"%s"' % key in tags:
+        return True
+    if '*' in tags or (headers.get('If-None-Match') == None and headers.get('If-Modified-Since') != None):
+        return backend.exists(key)
+    return False
+
+def serve_data(handler, key, data):
+    if data == None:
+        handler.error(404)
+        return False
+    handler.response.headers['Content-Type'] = key_content_type(key)
+    handler.response.headers['Accept-Ranges'] = 'bytes'
+    byte_range = parse_range(handler.request.headers.get('Range'), len(data))
+    if byte_range == False:
+        handler.response.status = 416
+        handler.response.headers['Content-Range'] = 'bytes */%d' % len(data)
+        return True
+    if byte_range != None:
+        start, end = byte_range
+        handler.response.status = 206
+        handler.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, len(data))
+        data = data[start:end + 1]
+    handler.response.out.write(data)
+    return True
+
+
+# Blobs as files in a directory, for running outside App Engine
+class FileStorage:
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        if not KEY_PATTERN.match(key):
+            return None
+        return os.path.join(self.directory, key)
+
+    def write(self, data, content_type):
+        key = new_key(content_type)
+        # written under a temporary name first, so a reader never sees half a blob
+        partial = self.path(key) + ".partial"
+        with open(partial, "wb") as f:
+            for chunk in chunks(data):
+                f.write(chunk)
+        os.rename(partial, self.path(key))
+        return key
+
+    def read(self, key):
+        path = self.path(key)
+        if path == None or not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def exists(self, key):
+        path = self.path(key)
+        return path != None and os.path.exists(path)
+
+    def serve(self, handler, key):
+        return serve_data(handler, key, self.read(key))
+
+
+# Blobs in a dict, for tests and benchmarks
+class MemoryStorage:
+    def __init__(self):
+        self.blobs = {}
+        self.lock = threading.Lock()
+
+    def write(self, data, content_type):
+        key = new_key(content_type)
+        data = "".join(chunks(data))
+        with self.lock:
+            self.blobs[key] = data
+        return key
+
+    def read(self, key):
+        with self.lock:
+            return self.blobs.get(key)
+
+    def exists(self, key):
+        with self.lock:
+            return key in self.blobs
+
+    def serve(self, handler, key):
+        return serve_data(handler, key, self.read(key))
+
+
+# Writes several (data, content_type) blobs at the same time, each on its own thread
+# Returns their keys in the same order, or raises the first error any of them hit
+def write_all(backend, blobs):
+    keys = [None] * len(blobs)
+    errors = []
+
+    def write(index, data, content_type):
+        try:
+            keys[index] = backend.write(data, content_type)
+        except Exception, e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(index, data, content_type))
+               for index, (data, content_type) in enumerate(blobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return keys
+
+
+backend = None
+backend_lock = threading.Lock()
+
+# Storage used by the app: set backend to choose one, otherwise the blobstore on App Engine,
+# files under $LIGHT_PALETTE_STORAGE when that is set, and memory when neither is
+def get_backend():
+    global backend
+    with backend_lock:
+        if backend == None:
+            if os.environ.get("LIGHT_PALETTE_STORAGE"):
+                backend = FileStorage(os.environ["LIGHT_PALETTE_STORAGE"])
+            else:
+                try:
+                    from google.appengine.api import files
+                    backend = AppEngineStorage()
+                except ImportError:
+                    backend = MemoryStorage()
+        return backend
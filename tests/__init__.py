@@ -0,0 +1,4 @@
+# Tests of the parts of the app that run without App Engine
+# Handler tests need webapp2 and the App Engine SDK, and skip themselves without them
+#
+# python -m unittest discover -s tests -t .
@@ -0,0 +1,52 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import batch
+import imaging
+from tests.test_imaging import photo_image
+
+
+class CompletedPathsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.output = os.path.join(self.directory, "results.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, *results):
+        with open(self.output, "a") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    def test_missing_output(self):
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"]), set())
+
+    def test_results_from_the_same_settings(self):
+        image = os.path.join(self.directory, "a.png")
+        photo_image().save(image)
+        self.write(*batch.extract_palette(image, ["TRIAD", "MONO"]))
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD", "MONO"]), set([image]))
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD", "TETRAD"]), set())
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"], engine="kmeans"), set())
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"], sample_budget=5000), set())
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"], exact_hsv=False), set())
+
+    def test_errors_are_done_again(self):
+        missing = os.path.join(self.directory, "missing.png")
+        self.write(*batch.extract_palette(missing, ["TRIAD"]))
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"]), set())
+
+    def test_cut_off_line(self):
+        self.write({"path": "a.png", "scheme": "TRIAD", "engine": "grid",
+                    "sample_budget": imaging.ColorFinder.SAMPLE_BUDGET, "exact_hsv": True, "colors": []})
+        with open(self.output, "a") as f:
+            f.write('{"path": "b.png", "scheme": "TRI')
+        self.assertEqual(batch.completed_paths(self.output, ["TRIAD"]), set(["a.png"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import sys
+import unittest
+
+import cache
+
+
+class LRUCacheTest(unittest.TestCase):
+    def test_evicts_least_recently_used(self):
+        lru = cache.LRUCache(10)
+        lru.put("a", "aaaa")
+        lru.put("b", "bbbb")
+        lru.get("a")
+        lru.put("c", "cccc")
+        self.assertEqual(lru.get("b"), None)
+        self.assertEqual(lru.get("a"), "aaaa")
+        self.assertEqual(lru.get("c"), "cccc")
+        self.assertEqual(lru.bytes, 8)
+
+    def test_skips_values_bigger_than_the_cache(self):
+        lru = cache.LRUCache(4)
+        lru.put("a", "aa")
+        lru.put("b", "b" * 5)
+        self.assertEqual(lru.get("b"), None)
+        self.assertEqual(lru.get("a"), "aa")
+
+    def test_sizeof(self):
+        lru = cache.LRUCache(100, sizeof=lambda value: value[0])
+        lru.put("a", (60,))
+        lru.put("b", (30,))
+        lru.put("a", (80,))
+        self.assertEqual(lru.bytes, 80)
+        self.assertEqual(lru.get("b"), None)
+        lru.delete("a")
+        self.assertEqual(lru.bytes, 0)
+        self.assertEqual(len(lru), 0)
+
+
+class DeepSizeofTest(unittest.TestCase):
+    def test_counts_every_part(self):
+        palette = "p" * 1000
+        histogram = "h" * 5000
+        colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (10, 10, 10)]
+        size = cache.deep_sizeof((palette, colors, histogram))
+        self.assertTrue(size > len(palette) + len(histogram) + sys.getsizeof(colors))
+        self.assertEqual(size, sys.getsizeof((palette, colors, histogram)) + sys.getsizeof(palette) +
+                         sys.getsizeof(histogram) + cache.deep_sizeof(colors))
+
+    def test_histogram_counts_against_the_cache(self):
+        lru = cache.LRUCache(10000, sizeof=cache.deep_sizeof)
+        lru.put("a", ("p" * 100, [(1, 2, 3)], "h" * 20000))
+        self.assertEqual(lru.get("a"), None)
+        self.assertEqual(lru.bytes, 0)
+
+
+class LocalMemcacheTest(unittest.TestCase):
+    def test_values_are_copies(self):
+        shared = cache.LocalMemcache()
+        value = [1]
+        shared.set("key", value)
+        value.append(2)
+        self.assertEqual(shared.get("key"), [1])
+
+    def test_namespaces(self):
+        shared = cache.LocalMemcache()
+        shared.set("key", 1, namespace="one")
+        self.assertEqual(shared.get("key"), None)
+        self.assertEqual(shared.get_multi(["key", "other"], namespace="one"), {"key": 1})
+
+    def test_incr(self):
+        shared = cache.LocalMemcache()
+        self.assertEqual(shared.incr("count"), None)
+        self.assertEqual(shared.incr("count", initial_value=0), 1)
+        self.assertEqual(shared.incr("count", initial_value=0), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
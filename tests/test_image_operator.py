@@ -0,0 +1,200 @@
+import cStringIO
+import imp
+import logging
+import sys
+import unittest
+
+import cache
+import perceptual
+import storage
+from tests.test_imaging import photo_image
+
+
+# Stands in for the parts of an ndb Key used by ImageOperator
+class Key:
+    def __init__(self, value, parent=None):
+        self.value = value
+        self.parent_key = parent
+
+    def urlsafe(self):
+        return self.value
+
+    def parent(self):
+        return self.parent_key
+
+    def get(self):
+        return Picture.stored.get(self.value)
+
+# Stands in for model.Picture, which needs the App Engine datastore
+class Picture:
+    stored = {}
+
+    def __init__(self, parent=None, id=None):
+        self.parent_key = parent
+        self.id = id
+        self.key = None
+        self.histogram = None
+
+    @staticmethod
+    def picture_key(username):
+        return Key(username)
+
+    @staticmethod
+    def source_key(username, source):
+        return Key("%s/%s" % (username, source), Key(username))
+
+    @staticmethod
+    def get_by_urlsafe(value):
+        return Picture.stored.get(value)
+
+    def put(self):
+        if self.id == None:
+            self.id = "picture-%d" % len(Picture.stored)
+        self.key = Key("%s/%s" % (self.parent_key.urlsafe(), self.id), self.parent_key)
+        Picture.stored[self.key.urlsafe()] = self
+        return self.key
+
+    def picture_data(self):
+        return storage.get_backend().read(self.picture)
+
+    def palette_data(self):
+        return storage.get_backend().read(self.palette)
+
+# image_operator imported with the stand-in model, and taken back out of sys.modules so nothing else gets it
+def load_image_operator():
+    saved = sys.modules.get("model")
+    model = imp.new_module("model")
+    model.Picture = Picture
+    sys.modules["model"] = model
+    try:
+        import image_operator
+        return image_operator
+    finally:
+        for name in ("image_operator", "gallery"):
+            sys.modules.pop(name, None)
+        if saved != None:
+            sys.modules["model"] = saved
+        else:
+            sys.modules.pop("model", None)
+
+image_operator = load_image_operator()
+
+def jpeg_bytes(image, quality=90):
+    output = cStringIO.StringIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+
+class ImageOperatorTest(unittest.TestCase):
+    def setUp(self):
+        Picture.stored = {}
+        shared = cache.LocalMemcache()
+        image_operator.palette_cache = cache.TieredCache("palettes", cache.LRUCache(1 << 20, sizeof=cache.deep_sizeof), shared)
+        image_operator.derivative_cache = cache.TieredCache("derivatives", cache.LRUCache(16, sizeof=lambda stored: 1), shared)
+        image_operator.near_duplicates = perceptual.NearDuplicateIndex(shared)
+        image_operator.gallery.shared = shared
+        storage.backend = storage.MemoryStorage()
+
+    def tearDown(self):
+        storage.backend = None
+
+    def test_near_duplicate_not_cached_for_others(self):
+        operator = image_operator.ImageOperator
+        original = jpeg_bytes(photo_image(seed=1))
+        operator.process("alice", original)
+        # the same photo saved again, which changes its bytes but not its hash
+        again = jpeg_bytes(photo_image(seed=1), quality=70)
+        hashed = perceptual.dhash(operator.decode(original))
+        reused = operator.render_palette(again, owner="alice", hashed=hashed)
+        self.assertEqual(image_operator.near_duplicates.hits, 1)
+        # anyone else uploading the same bytes gets a palette of their own upload
+        rendered = operator.render_palette(again, owner="bob", hashed=hashed)
+        expected = operator.render_palette(again)
+        self.assertEqual(rendered, expected)
+        self.assertNotEqual(reused[2], expected[2])
+
+    def test_one_decode(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        decoded = []
+        def decode(content):
+            decoded.append(content)
+            return decode.original(content)
+        decode.original = operator.decode
+        operator.decode = staticmethod(decode)
+        try:
+            operator.process("alice", content)
+        finally:
+            operator.decode = staticmethod(decode.original)
+        self.assertEqual(len(decoded), 1)
+
+    def test_derivative_widths(self):
+        operator = image_operator.ImageOperator
+        operator.process("alice", jpeg_bytes(photo_image(size=(1200, 300))))
+        operator.process("alice", jpeg_bytes(photo_image()))
+        pictures = sorted(Picture.stored.values(), key=lambda picture: picture.id)
+        self.assertEqual([(picture.thumbnail_width, picture.medium_width) for picture in pictures],
+                         # the second photo is narrower than either derivative, and isn't scaled up
+                         [(320, 1024), (160, 160)])
+
+    def test_derivatives_per_owner(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        operator.process("alice", content)
+        operator.process("alice", content)
+        operator.process("bob", content)
+        thumbnails = dict((key, picture.thumbnail) for key, picture in Picture.stored.items())
+        alice = [thumbnail for key, thumbnail in thumbnails.items() if key.startswith("alice/")]
+        bob = [thumbnail for key, thumbnail in thumbnails.items() if key.startswith("bob/")]
+        self.assertEqual(len(set(alice)), 1)
+        self.assertFalse(bob[0] in alice)
+
+    def test_bad_histogram(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        operator.process("alice", content)
+        picture = Picture.stored.values()[0]
+        expected = operator.repalette(picture)
+        picture.histogram = picture.histogram[:30]
+        logging.disable(logging.WARNING)
+        try:
+            self.assertEqual(operator.repalette(picture)[1], expected[1])
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_missing_original(self):
+        picture = Picture(parent=Picture.picture_key("alice"))
+        picture.picture = storage.new_key("image/jpeg")
+        self.assertRaises(image_operator.MissingOriginal, image_operator.ImageOperator.repalette, picture)
+
+    def test_same_source_twice(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        first = operator.process("alice", content, source="item-1").read()
+        blobs = len(storage.backend.blobs)
+        again = operator.process("alice", content, source="item-1").read()
+        self.assertEqual(again, first)
+        self.assertEqual(Picture.stored.keys(), ["alice/item-1"])
+        self.assertEqual(len(storage.backend.blobs), blobs)
+        operator.process("bob", content, source="item-1")
+        self.assertEqual(len(Picture.stored), 2)
+
+    def test_chunks(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        chunks = [content[start:start + 1000] for start in range(0, len(content), 1000)]
+        palette = operator.process("alice", chunks).read()
+        self.assertEqual(palette, operator.render_palette(content)[0])
+        picture = Picture.stored.values()[0]
+        self.assertEqual(picture.picture_data(), content)
+
+    def test_undecodable(self):
+        operator = image_operator.ImageOperator
+        content = jpeg_bytes(photo_image())
+        for bad in (content[:len(content) // 2], "not an image at all"):
+            self.assertRaises(image_operator.UndecodableImage, operator.process, "alice", bad)
+        self.assertEqual(Picture.stored, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,346 @@
+import cStringIO
+import random
+import unittest
+import zlib
+
+import Image
+import imaging
+
+
+# Random pixels clustered around a few colors, the same on every run
+def photo_image(size=(160, 120), seed=0):
+    rng = random.Random(seed)
+    centers = [(200, 30, 40), (20, 160, 60), (40, 60, 210), (240, 220, 30), (90, 90, 90)]
+    pixels = []
+    for i in range(size[0] * size[1]):
+        center = centers[(i // (size[0] * 7)) % len(centers)]
+        pixels.append(tuple(min(255, max(0, channel + rng.randint(-40, 40))) for channel in center))
+    image = Image.new("RGB", size)
+    image.putdata(pixels)
+    return image
+
+
+class NumpyHistogramTest(unittest.TestCase):
+    @unittest.skipIf(imaging.numpy is None, "needs numpy")
+    def test_same_as_python(self):
+        for budget in (imaging.ColorFinder.SAMPLE_BUDGET, None):
+            image = photo_image()
+            finder = imaging.ColorFinder(image, sample_budget=budget)
+            self.assertEqual(finder.computation.data, finder.compute_pop_map_python(image).data)
+
+
+class PriorityMapTest(unittest.TestCase):
+    # Same operations on a plain list, kept sorted by value with ties in insertion order
+    def test_same_as_sorted_list(self):
+        rng = random.Random(3)
+        priority_map = imaging.PriorityMap([(rng.randint(0, 9), [i]) for i in range(20)])
+        expected = sorted(priority_map.data, key=lambda entry: -entry[0])
+        for step in range(500):
+            action = rng.random()
+            if action < 0.5:
+                entry = (rng.randint(0, 9), [rng.randint(0, 40)])
+                priority_map.add(*entry)
+                position = len([other for other in expected if other[0] >= entry[0]])
+                expected.insert(position, entry)
+            elif action < 0.8:
+                item = [rng.randint(0, 40)]
+                priority_map.remove(item)
+                for i in range(len(expected)):
+                    if expected[i][1] == item:
+                        del expected[i]
+                        break
+            elif expected:
+                self.assertEqual(priority_map.pop(), expected.pop(0))
+            if step % 50 == 0:
+                copied = priority_map.pm_copy()
+                copied.add(10, [99])
+                copied.remove(expected[-1][1] if expected else [0])
+            self.assertEqual(len(priority_map), len(expected))
+            self.assertEqual(priority_map.top(3), expected[:3])
+        self.assertEqual(priority_map.data, expected)
+
+    def test_pop_empty(self):
+        self.assertRaises(IndexError, imaging.PriorityMap().pop)
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class VectorizedQualityTest(unittest.TestCase):
+    def setUp(self):
+        self.finder = imaging.ColorFinder(photo_image(), bits=3)
+        # the same colors in a PriorityMap, which is scored one color at a time
+        self.plain = imaging.PriorityMap(self.finder.conversion.data)
+
+    def test_same_as_per_color(self):
+        qualities = [imaging.ColorQualities.colorful(), imaging.ColorQualities.bright(),
+                     imaging.ColorQualities.dark(), imaging.ColorQualities.close(0.3)]
+        for quality in qualities:
+            for weights in ((0.5, 0.5), (0.1, 0.9), (0.2, 0.8)):
+                self.assertEqual(self.finder.find_quality_popular(quality, None, *weights),
+                                 self.finder.find_quality_popular(quality, self.plain, *weights))
+
+    def test_plain_callables(self):
+        quality = lambda color: color[1][2]
+        self.assertEqual(self.finder.find_quality_popular(quality),
+                         self.finder.find_quality_popular(imaging.ColorQualities.bright()))
+
+    def test_palettes(self):
+        for scheme in imaging.Palette.SCHEMES:
+            self.assertEqual(self.finder.strategy_enhanced_complements(scheme),
+                             self.finder.strategy_enhanced_complements(scheme, colormap=self.plain))
+
+
+def jpeg_image(size=(640, 480)):
+    output = cStringIO.StringIO()
+    photo_image().resize(size).save(output, format="JPEG")
+    return Image.open(cStringIO.StringIO(output.getvalue()))
+
+
+class ReduceImageTest(unittest.TestCase):
+    def test_leaves_image_alone(self):
+        image = jpeg_image()
+        reduced = imaging.ColorFinder.reduce_image(image, 20000)
+        reduced.load()
+        self.assertTrue(reduced.size[0] * reduced.size[1] < 640 * 480)
+        self.assertEqual(image.size, (640, 480))
+        image.load()
+        self.assertEqual(image.size, (640, 480))
+
+    def test_decoded_image(self):
+        image = jpeg_image()
+        image.load()
+        reduced = imaging.ColorFinder.reduce_image(image, 20000)
+        self.assertTrue(reduced.size[0] * reduced.size[1] <= 20000)
+        self.assertEqual(image.size, (640, 480))
+
+    def test_within_budget(self):
+        image = jpeg_image((100, 80))
+        self.assertTrue(imaging.ColorFinder.reduce_image(image, 20000) is image)
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class HSVLookupTest(unittest.TestCase):
+    def test_cell_centers(self):
+        centers = [(r, g, b) for r in range(4, 256, 24) for g in range(4, 256, 40) for b in range(4, 256, 56)]
+        looked_up = imaging.ColorUtil.lookup_hsv(centers)
+        exact = imaging.ColorUtil.convert_array_to_hsv(centers)
+        self.assertTrue(abs(looked_up - exact).max() < 1e-6)
+
+    def test_finder(self):
+        finder = imaging.ColorFinder(photo_image(), exact_hsv=False)
+        palette = finder.strategy_enhanced_complements(imaging.Palette.SCHEMES[0])
+        self.assertTrue(len(palette) > 0)
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class ArrayPopMapTest(unittest.TestCase):
+    def setUp(self):
+        rng = imaging.numpy.random.RandomState(4)
+        self.pixels = rng.randint(0, 256, (5000, 3))
+
+    def test_same_as_pop_map(self):
+        for bits in (2, 3, 4, 5):
+            expected = imaging.PopMap(bits)
+            for pixel in self.pixels.tolist():
+                expected.add(pixel)
+            histogram = imaging.ArrayPopMap(bits)
+            histogram.add_pixels(self.pixels[:2000])
+            histogram.add_pixels(self.pixels[2000:])
+            self.assertEqual(histogram.compute().data, expected.compute().data)
+
+    def test_adaptive(self):
+        histogram = imaging.ArrayPopMap(2, refine_bits=5, refine_cells=3)
+        histogram.add_pixels(self.pixels)
+        self.assertEqual(histogram.counts.sum(), len(self.pixels))
+        coarse = imaging.ArrayPopMap.bucket_index(self.pixels, 2)
+        cell_counts = imaging.numpy.bincount(coarse, minlength=64)
+        popular = imaging.numpy.argsort(-cell_counts, kind="mergesort")[:3]
+        refined = histogram.keys & 1 == 1
+        # refined buckets hold exactly the pixels of the most popular coarse cells, and nothing else is refined
+        self.assertEqual(histogram.counts[refined].sum(), cell_counts[popular].sum())
+        fine = histogram.keys[refined] >> 1
+        # the 2 bit cell each 5 bit bucket is in
+        cells = ((fine >> 13) << 4) | (((fine >> 8) & 3) << 2) | ((fine >> 3) & 3)
+        self.assertEqual(set(cells), set(popular))
+        self.assertEqual(set(histogram.keys[~refined] >> 1) & set(popular), set())
+
+    def test_adaptive_sparse(self):
+        histogram = imaging.ArrayPopMap(2, refine_bits=5)
+        histogram.add_pixels(self.pixels)
+        self.assertTrue(len(histogram.keys) <= len(self.pixels))
+        self.assertEqual(sum(entry[0] for entry in histogram.compute().data), len(self.pixels))
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class ClusterEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.pixels = imaging.numpy.array(photo_image().getdata())
+
+    def test_clusters(self):
+        for cls in (imaging.MedianCutMap, imaging.KMeansMap):
+            clusters = cls()
+            clusters.add_pixels(self.pixels[:9000])
+            clusters.add_pixels(self.pixels[9000:])
+            entries = clusters.compute().data
+            self.assertTrue(0 < len(entries) <= imaging.MedianCutMap.CLUSTERS)
+            self.assertEqual(sum(entry[0] for entry in entries), len(self.pixels))
+            for count, color in entries:
+                self.assertEqual(len(color), 3)
+                self.assertTrue(all(0 <= channel <= 255 for channel in color))
+            # the same pixels always give the same clusters
+            again = cls()
+            again.add_pixels(self.pixels)
+            self.assertEqual(again.compute().data, entries)
+
+    def test_few_colors(self):
+        pixels = imaging.numpy.array([(10, 20, 30)] * 50 + [(200, 100, 0)] * 30)
+        for cls in (imaging.MedianCutMap, imaging.KMeansMap):
+            clusters = cls()
+            clusters.add_pixels(pixels)
+            # median cut splits at the median pixel, so a color can end up in more than one cluster
+            totals = {}
+            for count, color in clusters.compute().data:
+                totals[tuple(color)] = totals.get(tuple(color), 0) + count
+            self.assertEqual(totals, {(10, 20, 30): 50, (200, 100, 0): 30})
+
+    def test_empty(self):
+        for cls in (imaging.MedianCutMap, imaging.KMeansMap):
+            self.assertEqual(cls().compute().data, [])
+
+    def test_engines(self):
+        grid = imaging.ColorFinder(photo_image())
+        self.assertEqual(grid.engine, "grid")
+        self.assertEqual(grid.computation.data, imaging.ColorFinder(photo_image(), engine="grid").computation.data)
+        for engine in ("mediancut", "kmeans"):
+            finder = imaging.ColorFinder(photo_image(), engine=engine)
+            self.assertEqual(sum(entry[0] for entry in finder.computation.data), finder.sample_count)
+            self.assertTrue(len(finder.strategy_enhanced_complements("TRIAD")) > 0)
+        self.assertRaises(ValueError, imaging.ColorFinder, photo_image(), engine="octree")
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class LabTest(unittest.TestCase):
+    def test_same_as_per_color(self):
+        colors = [(0, 0, 0), (255, 255, 255), (255, 0, 0), (3, 200, 90), (10, 10, 11), (128, 64, 250)]
+        colors += list(photo_image().getdata())[::97]
+        converted = imaging.ColorUtil.convert_array_to_lab(colors)
+        for i in range(len(colors)):
+            expected = imaging.ColorUtil.convert_to_lab(colors[i])
+            for channel in range(3):
+                self.assertAlmostEqual(converted[i][channel], expected[channel], places=9)
+
+    def test_known_colors(self):
+        white = imaging.ColorUtil.convert_to_lab((255, 255, 255))
+        self.assertAlmostEqual(white[0], 100, places=2)
+        self.assertAlmostEqual(white[1], 0, places=2)
+        self.assertAlmostEqual(white[2], 0, places=2)
+        red = imaging.ColorUtil.convert_to_lab((255, 0, 0))
+        self.assertAlmostEqual(red[0], 53.24, places=1)
+        self.assertAlmostEqual(red[1], 80.09, places=1)
+        self.assertAlmostEqual(red[2], 67.20, places=1)
+
+    def test_close_lab(self):
+        finder = imaging.ColorFinder(photo_image(), bits=3)
+        colormap = finder.conversion
+        for target in [(0.0, 1.0, 0.8), (0.6, 0.3, 0.5), (0.3, 0.9, 0.2)]:
+            for quality in (imaging.ColorQualities.close_lab(target), imaging.ColorQualities.contrast(target)):
+                scores = quality.score_array(colormap)
+                for i in range(len(colormap.items)):
+                    # per color scores go back to RGB from HSV, which can be one off the bucket average
+                    self.assertTrue(abs(scores[i] - quality.score((colormap.counts[i], colormap.items[i]))) < 0.02)
+
+    def test_lab_palettes(self):
+        finder = imaging.ColorFinder(photo_image())
+        palettes = finder.strategy_multi_complements(metric="lab")
+        for scheme in imaging.Palette.SCHEMES:
+            self.assertEqual(len(palettes[scheme]), len(getattr(imaging.Palette, scheme)) + 1)
+        self.assertRaises(ValueError, finder.strategy_multi_complements, metric="rgb")
+
+
+@unittest.skipIf(imaging.numpy is None, "needs numpy")
+class StreamingColorFinderTest(unittest.TestCase):
+    def test_before_any_frame(self):
+        finder = imaging.StreamingColorFinder()
+        self.assertEqual(finder.palette(), [])
+        self.assertEqual(finder.palette(metric="lab"), [])
+        self.assertEqual(finder.strategy_top_colors(3), [])
+
+    def test_one_frame(self):
+        finder = imaging.StreamingColorFinder()
+        finder.feed(photo_image())
+        expected = imaging.ColorFinder(photo_image())
+        self.assertEqual(finder.strategy_top_colors(5), expected.strategy_top_colors(5))
+        for scheme in imaging.Palette.SCHEMES:
+            self.assertEqual(finder.palette(scheme), expected.strategy_enhanced_complements(scheme))
+
+    def test_decay(self):
+        finder = imaging.StreamingColorFinder(decay=0.5)
+        finder.feed(photo_image(seed=1))
+        samples = finder.sample_count
+        finder.feed(photo_image(seed=2))
+        finder.refresh()
+        self.assertEqual(finder.frames, 2)
+        self.assertAlmostEqual(finder.sample_count, samples * 1.5)
+        self.assertAlmostEqual(sum(entry[0] for entry in finder.computation.data), samples * 1.5)
+        self.assertTrue(len(finder.palette()) > 0)
+
+
+class HistogramTest(unittest.TestCase):
+    def test_round_trip(self):
+        finder = imaging.ColorFinder(photo_image())
+        data = finder.dump_histogram()
+        stored = imaging.StoredColorFinder(data)
+        self.assertEqual(stored.dump_histogram(), data)
+        self.assertEqual(stored.sample_count, finder.sample_count)
+        for scheme in imaging.Palette.SCHEMES:
+            self.assertEqual(stored.strategy_enhanced_complements(scheme),
+                             finder.strategy_enhanced_complements(scheme))
+
+    @unittest.skipIf(imaging.numpy is None, "needs numpy")
+    def test_round_trip_settings(self):
+        for finder in (imaging.ColorFinder(photo_image(), bits=3, refine_bits=5),
+                       imaging.ColorFinder(photo_image(), engine="kmeans")):
+            stored = imaging.StoredColorFinder(finder.dump_histogram())
+            self.assertEqual((stored.bits, stored.refine_bits, stored.engine),
+                             (finder.bits, finder.refine_bits, finder.engine))
+            self.assertEqual(stored.computation.data, finder.computation.data)
+        streaming = imaging.StreamingColorFinder(decay=0.5)
+        streaming.feed(photo_image(seed=1))
+        streaming.feed(photo_image(seed=2))
+        stored = imaging.StoredColorFinder(streaming.dump_histogram())
+        self.assertEqual(stored.sample_count, streaming.sample_count)
+
+    def test_rejects_other_data(self):
+        self.assertRaises(ValueError, imaging.StoredColorFinder, "x" * imaging.ColorFinder.HISTOGRAM_HEADER.size)
+        self.assertRaises(ValueError, imaging.StoredColorFinder, "")
+        self.assertRaises(ValueError, imaging.StoredColorFinder, None)
+
+    def test_rejects_corrupt_data(self):
+        data = imaging.ColorFinder(photo_image()).dump_histogram()
+        size = imaging.ColorFinder.HISTOGRAM_HEADER.size
+        header = list(imaging.ColorFinder.HISTOGRAM_HEADER.unpack(data[:size]))
+        def with_header(index, value):
+            changed = list(header)
+            changed[index] = value
+            return imaging.ColorFinder.HISTOGRAM_HEADER.pack(*changed) + data[size:]
+        corrupt = [
+            data[:size - 1],
+            data[:size],
+            data[:-5],
+            data[:size] + "not zlib at all",
+            data[:size] + zlib.compress("short"),
+            data[:size + 10] + "\xff" * 10 + data[size + 20:],
+            with_header(2, 0),
+            with_header(2, 9),
+            with_header(3, 12),
+            with_header(4, len(imaging.ColorFinder.ENGINES)),
+            with_header(5, 6),
+            with_header(7, header[7] + 1),
+            with_header(7, header[7] - 1),
+            with_header(7, 1 << 30),
+        ]
+        for bad in corrupt:
+            self.assertRaises(ValueError, imaging.StoredColorFinder, bad)
+
+
+if __name__ == "__main__":
+    unittest.main()
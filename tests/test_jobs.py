@@ -0,0 +1,205 @@
+import itertools
+import logging
+import unittest
+
+import cache
+import jobs
+
+
+class LocalQueueTest(unittest.TestCase):
+    def setUp(self):
+        # failing jobs are logged on purpose
+        logging.disable(logging.CRITICAL)
+        self.queue = jobs.LocalQueue()
+        self.handled = []
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def record(self, user, job):
+        self.handled.append((user, job["n"]))
+
+    def test_order_for_each_user(self):
+        for n in range(3):
+            self.queue.enqueue("a", {"n": n})
+            self.queue.enqueue("b", {"n": n})
+        self.assertEqual(self.queue.work(self.record), 6)
+        self.assertEqual([n for user, n in self.handled if user == "a"], [0, 1, 2])
+        self.assertEqual([n for user, n in self.handled if user == "b"], [0, 1, 2])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_retry_keeps_order(self):
+        failures = [True]
+        def handle(user, job):
+            if job["n"] == 0 and failures:
+                failures.pop()
+                raise RuntimeError("try again")
+            self.record(user, job)
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("a", {"n": 1})
+        self.assertEqual(self.queue.work(handle), 0)
+        self.assertEqual(len(self.queue), 2)
+        self.queue.enqueue("a", {"n": 2})
+        self.queue.work(handle)
+        self.assertEqual(self.handled, [("a", 0), ("a", 1), ("a", 2)])
+
+    def test_drops_after_max_attempts(self):
+        attempts = []
+        def handle(user, job):
+            if job["n"] == 0:
+                attempts.append(1)
+                raise RuntimeError("always fails")
+            self.record(user, job)
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("a", {"n": 1})
+        for i in range(jobs.MAX_ATTEMPTS):
+            self.queue.work(handle)
+        self.assertEqual(len(attempts), jobs.MAX_ATTEMPTS)
+        self.assertEqual(self.handled, [("a", 1)])
+        self.assertEqual(len(self.queue), 0)
+
+    def test_drops_permanent_errors(self):
+        def handle(user, job):
+            if job["n"] == 0:
+                raise jobs.PermanentError("can't succeed")
+            self.record(user, job)
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("a", {"n": 1})
+        self.assertEqual(self.queue.work(handle), 2)
+        self.assertEqual(self.handled, [("a", 1)])
+
+    def test_one_user(self):
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("b", {"n": 1})
+        self.assertEqual(self.queue.work(self.record, "b"), 1)
+        self.assertEqual(self.handled, [("b", 1)])
+        self.assertEqual(len(self.queue), 1)
+
+
+# Stands in for the parts of the App Engine taskqueue module used by TaskQueue
+# Pull tasks are kept in the order they were added, and leases never run out on their own
+class FakeTask:
+    names = itertools.count()
+
+    def __init__(self, payload=None, method=None, tag=None, url=None, params=None, countdown=0):
+        self.name = "task-%d" % next(FakeTask.names)
+        self.payload = payload
+        self.tag = tag
+        self.params = params
+        self.countdown = countdown
+        self.retry_count = 0
+        self.leased = False
+
+class FakeQueue:
+    def __init__(self):
+        self.tasks = []
+
+    def add(self, task):
+        self.tasks.append(task)
+
+    def lease_tasks_by_tag(self, lease_seconds, max_tasks, tag=None):
+        available = [task for task in self.tasks if not task.leased]
+        if tag == None and available:
+            tag = available[0].tag
+        leased = [task for task in available if task.tag == tag][:max_tasks]
+        for task in leased:
+            task.leased = True
+            task.retry_count += 1
+        return leased
+
+    def modify_task_lease(self, task, lease_seconds):
+        task.leased = lease_seconds > 0
+
+    def delete_tasks(self, task):
+        self.tasks.remove(task)
+
+class FakeTaskqueue:
+    Task = FakeTask
+
+    def __init__(self):
+        self.queues = {}
+
+    def Queue(self, name):
+        return self.queues.setdefault(name, FakeQueue())
+
+
+class TaskQueueTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.taskqueue = FakeTaskqueue()
+        self.memcache = cache.LocalMemcache()
+        self.queue = jobs.TaskQueue(taskqueue=self.taskqueue, memcache=self.memcache)
+        self.handled = []
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def record(self, user, job):
+        self.handled.append((user, job["n"]))
+
+    def wakes(self):
+        return [(task.params["user"], task.countdown) for task in self.taskqueue.Queue("share-workers").tasks]
+
+    def test_wakes_for_the_user(self):
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("b", {"n": 1})
+        self.assertEqual(self.wakes(), [("a", 0), ("b", 0)])
+        self.assertEqual(self.queue.work(self.record, "b"), 1)
+        self.assertEqual(self.handled, [("b", 1)])
+        self.assertEqual(self.queue.work(self.record), 1)
+        self.assertEqual(self.handled, [("b", 1), ("a", 0)])
+        self.assertEqual(self.taskqueue.Queue("shares").tasks, [])
+
+    def test_busy_user_is_left_alone(self):
+        self.queue.enqueue("a", {"n": 0})
+        self.memcache.add("worker:a", True, namespace="shares")
+        self.assertEqual(self.queue.work(self.record, "a"), 0)
+        task = self.taskqueue.Queue("shares").tasks[0]
+        self.assertEqual(task.retry_count, 0)
+        self.assertFalse(task.leased)
+        self.assertEqual(self.wakes()[-1], ("a", jobs.TaskQueue.RETRY_SECONDS))
+        self.memcache.delete("worker:a", namespace="shares")
+        self.assertEqual(self.queue.work(self.record, "a"), 1)
+
+    def test_counts_attempts(self):
+        def handle(user, job):
+            raise RuntimeError("always fails")
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("a", {"n": 1})
+        self.memcache.add("worker:a", True, namespace="shares")
+        for i in range(jobs.MAX_ATTEMPTS * 2):
+            # a busy user doesn't use up any attempts
+            self.queue.work(handle, "a")
+        self.memcache.delete("worker:a", namespace="shares")
+        for i in range(jobs.MAX_ATTEMPTS - 1):
+            self.assertEqual(self.queue.work(handle, "a"), 0)
+        self.assertEqual(len(self.taskqueue.Queue("shares").tasks), 2)
+        self.queue.work(self.record, "a")
+        self.assertEqual(self.handled, [("a", 0), ("a", 1)])
+        for i in range(jobs.MAX_ATTEMPTS):
+            self.queue.work(handle, "a")
+        self.assertEqual(self.taskqueue.Queue("shares").tasks, [])
+        self.assertEqual(self.memcache.values, {})
+
+    def test_drops_permanent_errors(self):
+        def handle(user, job):
+            if job["n"] == 0:
+                raise jobs.PermanentError("can't succeed")
+            self.record(user, job)
+        self.queue.enqueue("a", {"n": 0})
+        self.queue.enqueue("a", {"n": 1})
+        self.assertEqual(self.queue.work(handle, "a"), 2)
+        self.assertEqual(self.handled, [("a", 1)])
+
+    def test_full_batch_wakes_again(self):
+        for n in range(jobs.BATCH_SIZE + 1):
+            self.queue.enqueue("a", {"n": n})
+        wakes = len(self.wakes())
+        self.assertEqual(self.queue.work(self.record, "a"), jobs.BATCH_SIZE)
+        self.assertEqual(self.wakes()[wakes:], [("a", 0)])
+        self.assertEqual(self.queue.work(self.record, "a"), 1)
+        self.assertEqual([n for user, n in self.handled], range(jobs.BATCH_SIZE + 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
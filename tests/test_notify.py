@@ -0,0 +1,72 @@
+import cStringIO
+import os
+import sys
+import unittest
+
+import storage
+from tests.test_imaging import photo_image
+
+# The handler needs webapp2, the App Engine SDK and the API client in lib
+try:
+    sys.path.insert(0, "lib")
+    import webapp2
+    from google.appengine.ext import testbed
+    import apiclient
+except ImportError:
+    webapp2 = None
+finally:
+    sys.path.remove("lib")
+
+def jpeg_bytes(image, **options):
+    output = cStringIO.StringIO()
+    image.save(output, format="JPEG", **options)
+    return output.getvalue()
+
+def write_in_chunks(buf, data, size=16 * 1024):
+    for start in range(0, len(data), size):
+        buf.write(data[start:start + size])
+
+
+@unittest.skipIf(webapp2 == None, "needs webapp2, the App Engine SDK and the API client")
+class AttachmentBufferTest(unittest.TestCase):
+    def setUp(self):
+        sys.path.insert(0, "lib")
+        from notify import handler
+        self.handler = handler
+
+    def tearDown(self):
+        sys.path.remove("lib")
+
+    def test_chunks_passed_through(self):
+        data = jpeg_bytes(photo_image())
+        buf = self.handler.AttachmentBuffer()
+        write_in_chunks(buf, data, 1000)
+        self.assertEqual(buf.image_size, (160, 120))
+        chunks = buf.getvalue()
+        self.assertTrue(isinstance(chunks, list))
+        self.assertEqual("".join(chunks), data)
+
+    def test_long_header(self):
+        # an ICC profile longer than the first few chunks
+        data = jpeg_bytes(photo_image(), icc_profile=os.urandom(70 * 1024))
+        buf = self.handler.AttachmentBuffer()
+        write_in_chunks(buf, data)
+        self.assertEqual(buf.image_size, (160, 120))
+        self.assertEqual(storage.data_length(buf.getvalue()), len(data))
+
+    def test_too_many_bytes(self):
+        buf = self.handler.AttachmentBuffer(max_bytes=1000)
+        self.assertRaises(self.handler.AttachmentError, write_in_chunks, buf, jpeg_bytes(photo_image()), 600)
+
+    def test_too_many_pixels(self):
+        buf = self.handler.AttachmentBuffer(max_pixels=160 * 120 - 1)
+        self.assertRaises(self.handler.AttachmentError, write_in_chunks, buf, jpeg_bytes(photo_image()))
+
+    def test_not_an_image(self):
+        buf = self.handler.AttachmentBuffer()
+        write_in_chunks(buf, "not an image " * 10000)
+        self.assertRaises(self.handler.AttachmentError, buf.getvalue)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import sys
+import unittest
+
+import imaging
+from tests.test_imaging import photo_image
+
+# The handler itself needs webapp2, the App Engine SDK and a session.secret
+try:
+    sys.path.insert(0, "lib")
+    import webapp2
+    from google.appengine.ext import testbed
+except ImportError:
+    webapp2 = None
+finally:
+    sys.path.remove("lib")
+
+
+@unittest.skipIf(webapp2 == None or not os.path.exists("session.secret"), "needs webapp2 and the App Engine SDK")
+class PaletteHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        sys.path.insert(0, "lib")
+        from model import Picture
+        from palettes import handler
+        self.handler = handler
+        self.app = webapp2.WSGIApplication(handler.PALETTE_ROUTES)
+        self.load_session_userid = handler.util.load_session_userid
+        self.userid = "alice"
+        handler.util.load_session_userid = lambda request_handler: self.userid
+        handler.rendered_cache = handler.cache.LRUCache(handler.RENDERED_CACHE_BYTES)
+        picture = Picture(parent=Picture.picture_key("alice"))
+        picture.histogram = imaging.ColorFinder(photo_image()).dump_histogram()
+        self.resource = picture.put().urlsafe()
+        missing = Picture(parent=Picture.picture_key("alice"))
+        self.missing_original = missing.put().urlsafe()
+
+    def tearDown(self):
+        self.handler.util.load_session_userid = self.load_session_userid
+        sys.path.remove("lib")
+        self.testbed.deactivate()
+
+    def get(self, resource, **headers):
+        return webapp2.Request.blank("/palette/" + resource, headers=headers).get_response(self.app)
+
+    def test_owner(self):
+        response = self.get(self.resource)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.headers["Content-Type"], "image/jpeg")
+        self.assertTrue(response.headers["Cache-Control"].startswith("private"))
+        again = self.get(self.resource, **{"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(again.status_int, 304)
+        weak = self.get(self.resource, **{"If-None-Match": "W/" + response.headers["ETag"]})
+        self.assertEqual(weak.status_int, 304)
+
+    def test_other_users(self):
+        self.userid = "bob"
+        self.assertEqual(self.get(self.resource).status_int, 404)
+        self.assertEqual(self.get(self.resource, **{"If-None-Match": "*"}).status_int, 404)
+        self.userid = None
+        self.assertEqual(self.get(self.resource).status_int, 404)
+
+    def test_any_version(self):
+        self.assertEqual(self.get(self.resource, **{"If-None-Match": "*"}).status_int, 304)
+        from model import Picture
+        deleted = Picture(parent=Picture.picture_key("alice"))
+        key = deleted.put()
+        key.delete()
+        self.assertEqual(self.get(key.urlsafe(), **{"If-None-Match": "*"}).status_int, 404)
+
+    def test_missing_original(self):
+        self.assertEqual(self.get(self.missing_original).status_int, 404)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.get("not-a-key").status_int, 404)
+        self.assertEqual(self.get(self.resource + "?scheme=PLAID").status_int, 400)
+        self.assertEqual(self.get(self.resource + "?size=0x10").status_int, 400)
+
+
+if __name__ == "__main__":
+    unittest.main()
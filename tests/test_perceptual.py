@@ -0,0 +1,126 @@
+import random
+import threading
+import unittest
+
+import cache
+import perceptual
+from tests.test_imaging import jpeg_image, photo_image
+
+
+class DHashTest(unittest.TestCase):
+    def test_survives_reencoding(self):
+        original = perceptual.dhash(photo_image())
+        self.assertTrue(perceptual.hamming(original, perceptual.dhash(jpeg_image())) <= 6)
+        self.assertTrue(perceptual.hamming(original, perceptual.dhash(photo_image(seed=5).rotate(90))) > 6)
+
+
+class BKTreeTest(unittest.TestCase):
+    def test_same_as_brute_force(self):
+        rng = random.Random(2)
+        base = [rng.getrandbits(64) for i in range(20)]
+        hashes = []
+        for i in range(400):
+            # hashes clustered around a few bases, so searches find more than one
+            hashed = rng.choice(base)
+            for bit in rng.sample(range(64), rng.randint(0, 10)):
+                hashed ^= 1 << bit
+            hashes.append(hashed)
+        tree = perceptual.BKTree()
+        values = {}
+        for i, hashed in enumerate(hashes):
+            tree.add(hashed, i)
+            values[hashed] = i
+        self.assertEqual(len(tree), len(values))
+        for query in base + hashes[:50]:
+            for threshold in (0, 3, 8):
+                expected = sorted((perceptual.hamming(query, hashed), hashed, value)
+                                  for hashed, value in values.items()
+                                  if perceptual.hamming(query, hashed) <= threshold)
+                found = tree.search(query, threshold)
+                self.assertEqual(sorted(found), expected)
+                self.assertEqual([entry[0] for entry in found], sorted(entry[0] for entry in found))
+
+    def test_empty(self):
+        self.assertEqual(perceptual.BKTree().search(0, 10), [])
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.shared = cache.LocalMemcache()
+        self.index = perceptual.NearDuplicateIndex(self.shared, max_entries=8)
+
+    def test_find(self):
+        self.assertEqual(self.index.find("alice", 0xff), None)
+        self.index.add("alice", 0xff, "first")
+        self.index.add("alice", 0xff00ff00, "second")
+        self.assertEqual(self.index.find("alice", 0xfe), "first")
+        self.assertEqual(self.index.find("alice", 0xff00ff01), "second")
+        self.assertEqual(self.index.find("bob", 0xff), None)
+        self.assertEqual(self.index.stats()["hits"], 2)
+
+    def test_other_instances(self):
+        other = perceptual.NearDuplicateIndex(self.shared, max_entries=8)
+        self.assertEqual(self.index.find("alice", 0xff), None)
+        other.add("alice", 0xff, "first")
+        self.assertEqual(self.index.find("alice", 0xff), "first")
+
+    def test_ring(self):
+        rng = random.Random(1)
+        hashes = [rng.getrandbits(64) for i in range(20)]
+        for i in range(20):
+            self.index.add("alice", hashes[i], i)
+            self.assertEqual(self.index.find("alice", hashes[i]), i)
+        # only the last max_entries are kept
+        self.assertEqual(self.index.find("alice", hashes[2]), None)
+        self.assertEqual(self.index.find("alice", hashes[15]), 15)
+        self.assertTrue(len(self.index.trees["alice"][0]) <= 8)
+
+    def test_late_slot(self):
+        self.index.add("alice", 0xff, "first")
+        # an upload that has taken its number but not written its slot yet
+        number = self.shared.incr("count:alice", namespace=self.index.namespace, initial_value=0)
+        self.index.add("alice", 0xff0000, "third")
+        self.assertEqual(self.index.find("alice", 0xff00), None)
+        self.assertEqual(self.index.find("alice", 0xff0000), "third")
+        self.shared.set(self.index.slot_key("alice", number), (number, 0xff00, "second"), namespace=self.index.namespace)
+        self.assertEqual(self.index.find("alice", 0xff00), "second")
+        self.assertEqual(self.index.trees["alice"][1], 3)
+
+    def test_slot_never_written(self):
+        index = perceptual.NearDuplicateIndex(self.shared, max_entries=64)
+        self.shared.incr("count:alice", namespace=index.namespace, initial_value=0)
+        late = perceptual.NearDuplicateIndex.LATE_SLOTS
+        for i in range(late - 1):
+            index.add("alice", 1 << i, i)
+        index.find("alice", 1)
+        self.assertEqual(index.trees["alice"][1], 0)
+        index.add("alice", 1 << 40, 40)
+        # the missing slot is given up on once it is LATE_SLOTS behind
+        index.find("alice", 1)
+        self.assertEqual(index.trees["alice"][1], late + 1)
+
+    def test_threads(self):
+        index = perceptual.NearDuplicateIndex(self.shared, max_entries=64, max_users=2)
+        errors = []
+        def work(seed):
+            rng = random.Random(seed)
+            try:
+                for i in range(200):
+                    owner = rng.choice(["alice", "bob", "carol"])
+                    hashed = rng.getrandbits(64)
+                    index.add(owner, hashed, hashed)
+                    found = index.find(owner, hashed)
+                    if found != hashed:
+                        errors.append((owner, hashed, found))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(seed,)) for seed in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
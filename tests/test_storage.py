@@ -0,0 +1,193 @@
+import cStringIO
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import storage
+
+
+class FakeResponse:
+    def __init__(self):
+        self.status = 200
+        self.headers = {}
+        self.out = cStringIO.StringIO()
+
+class FakeRequest:
+    def __init__(self, headers):
+        self.headers = headers
+
+# Just enough of a webapp2 handler for serve_data
+class FakeHandler:
+    def __init__(self, headers=None):
+        self.request = FakeRequest(headers or {})
+        self.response = FakeResponse()
+
+    def error(self, code):
+        self.response.status = code
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_no_range(self):
+        self.assertEqual(storage.parse_range(None, 100), None)
+        self.assertEqual(storage.parse_range("bytes=-", 100), None)
+        self.assertEqual(storage.parse_range("bytes=0-1,5-6", 100), None)
+
+    def test_ranges(self):
+        self.assertEqual(storage.parse_range("bytes=0-9", 100), (0, 9))
+        self.assertEqual(storage.parse_range("bytes=90-", 100), (90, 99))
+        self.assertEqual(storage.parse_range("bytes=-10", 100), (90, 99))
+        self.assertEqual(storage.parse_range("bytes=-500", 100), (0, 99))
+        self.assertEqual(storage.parse_range("bytes=50-500", 100), (50, 99))
+
+    def test_outside_data(self):
+        self.assertEqual(storage.parse_range("bytes=100-", 100), False)
+        self.assertEqual(storage.parse_range("bytes=9-5", 100), False)
+
+
+class ServeDataTest(unittest.TestCase):
+    DATA = "0123456789"
+
+    def test_whole(self):
+        handler = FakeHandler()
+        self.assertTrue(storage.serve_data(handler, "a" * 32 + ".jpg", self.DATA))
+        self.assertEqual(handler.response.status, 200)
+        self.assertEqual(handler.response.headers["Content-Type"], "image/jpeg")
+        self.assertEqual(handler.response.out.getvalue(), self.DATA)
+
+    def test_partial(self):
+        handler = FakeHandler({"Range": "bytes=2-4"})
+        storage.serve_data(handler, "a" * 32, self.DATA)
+        self.assertEqual(handler.response.status, 206)
+        self.assertEqual(handler.response.headers["Content-Range"], "bytes 2-4/10")
+        self.assertEqual(handler.response.out.getvalue(), "234")
+
+    def test_unsatisfiable(self):
+        handler = FakeHandler({"Range": "bytes=20-"})
+        storage.serve_data(handler, "a" * 32, self.DATA)
+        self.assertEqual(handler.response.status, 416)
+        self.assertEqual(handler.response.headers["Content-Range"], "bytes */10")
+        self.assertEqual(handler.response.out.getvalue(), "")
+
+    def test_missing(self):
+        handler = FakeHandler()
+        self.assertFalse(storage.serve_data(handler, "a" * 32, None))
+        self.assertEqual(handler.response.status, 404)
+
+
+class BackendTests:
+    def test_round_trip(self):
+        key = self.backend.write("picture bytes", "image/jpeg")
+        self.assertTrue(storage.KEY_PATTERN.match(key))
+        self.assertTrue(key.endswith(".jpg"))
+        self.assertEqual(self.backend.read(key), "picture bytes")
+
+    def test_missing(self):
+        self.assertEqual(self.backend.read("0" * 32 + ".jpg"), None)
+
+    def test_exists(self):
+        key = self.backend.write("picture bytes", "image/jpeg")
+        self.assertTrue(self.backend.exists(key))
+        self.assertFalse(self.backend.exists("0" * 32 + ".jpg"))
+
+    def test_chunks(self):
+        key = self.backend.write(["picture ", "", "bytes"], "image/jpeg")
+        self.assertEqual(self.backend.read(key), "picture bytes")
+
+    def test_write_all(self):
+        blobs = [("blob %d" % i, "image/png") for i in range(6)]
+        keys = storage.write_all(self.backend, blobs)
+        self.assertEqual(len(set(keys)), 6)
+        self.assertEqual([self.backend.read(key) for key in keys], [data for data, content_type in blobs])
+
+class MemoryStorageTest(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.backend = storage.MemoryStorage()
+
+class FileStorageTest(BackendTests, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.backend = storage.FileStorage(os.path.join(self.directory, "blobs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_partial_files(self):
+        key = self.backend.write("picture bytes", "image/jpeg")
+        self.assertEqual(os.listdir(self.backend.directory), [key])
+
+    def test_rejects_paths(self):
+        self.assertEqual(self.backend.read("../" + "0" * 32), None)
+
+
+class NotModifiedTest(unittest.TestCase):
+    def setUp(self):
+        self.backend = storage.MemoryStorage()
+        self.key = self.backend.write("picture bytes", "image/jpeg")
+        self.missing = "0" * 32 + ".jpg"
+
+    def test_none_match_tags(self):
+        self.assertEqual(storage.none_match_tags(None), [])
+        self.assertEqual(storage.none_match_tags(' "a", W/"b" ,*'), ['"a"', '"b"', '*'])
+
+    def test_etag(self):
+        etag = '"%s"' % self.key
+        self.assertTrue(storage.not_modified(self.backend, self.key, {"If-None-Match": etag}))
+        self.assertTrue(storage.not_modified(self.backend, self.key, {"If-None-Match": '"other", W/' + etag}))
+        self.assertFalse(storage.not_modified(self.backend, self.key, {"If-None-Match": '"other"'}))
+        self.assertFalse(storage.not_modified(self.backend, self.key, {}))
+
+    def test_any_version(self):
+        for headers in ({"If-None-Match": "*"}, {"If-Modified-Since": "Tue, 01 Jan 2013 00:00:00 GMT"}):
+            self.assertTrue(storage.not_modified(self.backend, self.key, headers))
+            self.assertFalse(storage.not_modified(self.backend, self.missing, headers))
+        # If-None-Match is used instead of If-Modified-Since when there are both
+        self.assertFalse(storage.not_modified(self.backend, self.key, {
+            "If-None-Match": '"other"', "If-Modified-Since": "Tue, 01 Jan 2013 00:00:00 GMT"}))
+
+
+class ChunkReaderTest(unittest.TestCase):
+    def test_same_as_one_string(self):
+        rng = random.Random(3)
+        data = "".join(chr(rng.randrange(256)) for i in range(1000)).replace("\n", "x")
+        data = data[:300] + "\n" + data[300:]
+        cuts = sorted(rng.sample(range(1, len(data)), 20))
+        chunks = [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+        expected = cStringIO.StringIO(data)
+        chunked = storage.ChunkReader(chunks)
+        for i in range(200):
+            whence = rng.choice([0, 1, 2])
+            offset = rng.randint(-50, 1050) if whence == 0 else rng.randint(-300, 300)
+            if whence == 2:
+                offset = -abs(offset)
+            if whence == 1 and expected.tell() + offset < 0:
+                offset = -expected.tell()
+            size = rng.choice([-1, 0, 1, 7, 100])
+            expected.seek(max(0, offset) if whence == 0 else offset, whence)
+            chunked.seek(offset, whence)
+            self.assertEqual(chunked.tell(), expected.tell())
+            self.assertEqual(chunked.read(size), expected.read(size))
+        chunked.seek(0)
+        self.assertEqual(chunked.readline(), data[:301])
+        self.assertEqual(chunked.read(), data[301:])
+        self.assertEqual(chunked.readline(), "")
+
+    def test_helpers(self):
+        self.assertEqual(storage.data_length(["ab", "", "cde"]), 5)
+        self.assertEqual(storage.data_length("abcde"), 5)
+        self.assertEqual(storage.data_digest(["ab", "", "cde"]), storage.data_digest("abcde"))
+
+
+class WriteAllErrorTest(unittest.TestCase):
+    def test_raises(self):
+        class Failing(storage.MemoryStorage):
+            def write(self, data, content_type):
+                if data == "bad":
+                    raise IOError("disk full")
+                return storage.MemoryStorage.write(self, data, content_type)
+        self.assertRaises(IOError, storage.write_all, Failing(), [("good", "image/jpeg"), ("bad", "image/jpeg")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import json
+import logging
+import threading
+import unittest
+
+import timing
+
+
+# Keeps the "timing" lines logged while it is attached
+class Lines(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(record.getMessage())
+
+
+class TimingTest(unittest.TestCase):
+    def setUp(self):
+        timing.reset()
+        self.logged = Lines()
+        self.logger = logging.getLogger()
+        self.level = self.logger.level
+        self.logger.addHandler(self.logged)
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.logged)
+        self.logger.setLevel(self.level)
+        timing.enabled = True
+        timing.reset()
+
+    def summary(self):
+        self.assertEqual(len(self.logged.lines), 1)
+        self.assertTrue(self.logged.lines[0].startswith("timing "))
+        return json.loads(self.logged.lines[0][len("timing "):])
+
+    def test_spans_in_a_trace(self):
+        with timing.trace("upload"):
+            with timing.span("decode") as span:
+                span.nbytes = 100
+            with timing.span("decode", 50):
+                pass
+            with timing.span("encode"):
+                pass
+            timing.add_bytes("write", 10)
+        summary = self.summary()
+        self.assertEqual(summary["trace"], "upload")
+        self.assertEqual(summary["stages"].keys(), ["decode", "encode", "write"])
+        self.assertEqual(summary["stages"]["decode"]["bytes"], 150)
+        self.assertEqual(summary["stages"]["decode"]["count"], 2)
+        self.assertFalse("bytes" in summary["stages"]["encode"])
+        self.assertEqual(summary["stages"]["write"], {"ms": 0.0, "bytes": 10})
+        self.assertEqual(timing.current(), None)
+
+    def test_spans_outside_a_trace(self):
+        with timing.span("decode") as span:
+            span.nbytes = 100
+        timing.add_bytes("write", 10)
+        self.assertTrue(span is timing.NULL_SPAN)
+        self.assertEqual(timing.NULL_SPAN.nbytes, None)
+        self.assertEqual(timing.end(), None)
+        self.assertEqual(self.logged.lines, [])
+        self.assertEqual(timing.percentiles(), {})
+
+    def test_disabled(self):
+        timing.enabled = False
+        with timing.trace("upload") as trace:
+            with timing.span("decode"):
+                pass
+        self.assertEqual(trace, None)
+        self.assertEqual(self.logged.lines, [])
+        self.assertEqual(timing.percentiles(), {})
+
+    def test_exception_ends_the_trace(self):
+        def fail():
+            with timing.trace("upload"):
+                with timing.span("decode"):
+                    raise ValueError("broken")
+        self.assertRaises(ValueError, fail)
+        self.assertEqual(timing.current(), None)
+        self.assertTrue("decode" in self.summary()["stages"])
+
+    def test_percentiles(self):
+        for seconds in range(1, 101):
+            with timing.windows_lock:
+                timing.observe("upload.decode", seconds)
+        result = timing.percentiles()["upload.decode"]
+        self.assertEqual(result, {"count": 100, "p50": 51, "p90": 91, "p99": 100})
+        for seconds in range(timing.WINDOW):
+            with timing.windows_lock:
+                timing.observe("upload.decode", 0)
+        self.assertEqual(timing.percentiles()["upload.decode"]["p99"], 0)
+
+    def test_traces_are_per_thread(self):
+        started = threading.Event()
+        finished = threading.Event()
+        def other():
+            with timing.trace("other"):
+                started.set()
+                finished.wait()
+        thread = threading.Thread(target=other)
+        thread.start()
+        started.wait()
+        with timing.span("decode") as span:
+            pass
+        self.assertTrue(span is timing.NULL_SPAN)
+        finished.set()
+        thread.join()
+        self.assertEqual(self.summary()["trace"], "other")
+        self.assertTrue("other" in timing.percentiles())
+
+
+if __name__ == "__main__":
+    unittest.main()
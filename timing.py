@@ -0,0 +1,164 @@
+import collections
+import json
+import logging
+import threading
+import time
+
+# Per-request timings of each stage of handling an image
+# A request is wrapped in trace(name), and the stages inside it in span(stage, nbytes)
+# When the trace ends, a single "timing {...}" line is logged with the seconds and bytes of each stage,
+# and the durations are added to rolling windows for percentiles in this instance
+# Spans outside of a trace, or with enabled = False, do nothing
+#
+#   with timing.trace("notify"):
+#       with timing.span("download") as s:
+#           content = fetch()
+#           s.nbytes = len(content)
+enabled = True
+
+# How many of the most recent durations the percentiles of each stage are worked out from
+WINDOW = 1000
+
+local = threading.local()
+windows = {}
+windows_lock = threading.Lock()
+
+
+# Stages of a single request, stage -> [seconds, bytes, count]
+# A stage can run more than once in a request, its times and bytes are added up
+class Trace:
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.elapsed = None
+        self.stages = collections.OrderedDict()
+
+    def record(self, stage, seconds, nbytes=None):
+        entry = self.stages.get(stage)
+        if entry == None:
+            entry = [0.0, None, 0]
+            self.stages[stage] = entry
+        entry[0] += seconds
+        entry[2] += 1
+        if nbytes != None:
+            entry[1] = (entry[1] or 0) + nbytes
+
+    def summary(self):
+        stages = collections.OrderedDict()
+        for stage, (seconds, nbytes, count) in self.stages.items():
+            entry = {"ms": round(seconds * 1000, 2)}
+            if nbytes != None:
+                entry["bytes"] = nbytes
+            if count > 1:
+                entry["count"] = count
+            stages[stage] = entry
+        return {"trace": self.name, "ms": round((self.elapsed or 0) * 1000, 2), "stages": stages}
+
+
+class Span:
+    __slots__ = ("trace", "stage", "nbytes", "start")
+
+    def __init__(self, trace, stage, nbytes):
+        self.trace = trace
+        self.stage = stage
+        self.nbytes = nbytes
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        self.trace.record(self.stage, time.time() - self.start, self.nbytes)
+        return False
+
+
+# Stands in for Span when nothing is being recorded, setting nbytes on it is allowed and ignored
+class NullSpan:
+    nbytes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+# The trace of the request this thread is handling, or None
+def current():
+    return getattr(local, "trace", None)
+
+def span(stage, nbytes=None):
+    trace = getattr(local, "trace", None)
+    if trace == None:
+        return NULL_SPAN
+    return Span(trace, stage, nbytes)
+
+# Adds bytes to a stage without timing anything
+def add_bytes(stage, nbytes):
+    trace = getattr(local, "trace", None)
+    if trace != None:
+        trace.record(stage, 0.0, nbytes)
+
+def begin(name):
+    if not enabled:
+        return None
+    local.trace = Trace(name)
+    return local.trace
+
+# Ends the trace of this thread, logs its summary and adds it to the percentiles
+def end():
+    trace = getattr(local, "trace", None)
+    if trace == None:
+        return None
+    local.trace = None
+    trace.elapsed = time.time() - trace.start
+    logging.info("timing %s", json.dumps(trace.summary()))
+    with windows_lock:
+        observe(trace.name, trace.elapsed)
+        for stage, entry in trace.stages.items():
+            observe("%s.%s" % (trace.name, stage), entry[0])
+    return trace
+
+# Expects windows_lock to be held
+def observe(key, seconds):
+    window = windows.get(key)
+    if window == None:
+        window = collections.deque(maxlen=WINDOW)
+        windows[key] = window
+    window.append(seconds)
+
+
+# Context manager around begin and end, an exception ends the trace too
+class trace:
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        return begin(self.name)
+
+    def __exit__(self, kind, value, traceback):
+        end()
+        return False
+
+
+# {"trace.stage": {"count": n, "p50": s, "p90": s, "p99": s}, ...} over the recent durations of each stage
+# The whole request is under just "trace"
+def percentiles(points=(50, 90, 99)):
+    with windows_lock:
+        samples = dict((key, sorted(window)) for key, window in windows.items())
+    result = {}
+    for key, values in samples.items():
+        entry = {"count": len(values)}
+        for point in points:
+            entry["p%d" % point] = values[min(len(values) - 1, int(len(values) * point / 100.0))]
+        result[key] = entry
+    return result
+
+def reset():
+    with windows_lock:
+        windows.clear()
@@ -39,10 +39,15 @@ def get_full_url(request_handler, path):
   return '%s://%s%s' % (pr.scheme, pr.netloc, path)
 
 
+def load_session_userid(request_handler):
+  """Load the user ID of the current session, or None, without its credentials."""
+  session = sessions.LilCookies(request_handler, SESSION_SECRET)
+  return session.get_secure_cookie(name='userid') or None
+
+
 def load_session_credentials(request_handler):
   """Load credentials from the current session."""
-  session = sessions.LilCookies(request_handler, SESSION_SECRET)
-  userid = session.get_secure_cookie(name='userid')
+  userid = load_session_userid(request_handler)
   if userid:
     return userid, StorageByKeyName(Credentials, userid, 'credentials').get()
   else: